@@ -1,40 +1,113 @@
 """
 Runner for REBooT related programs
+
+Streamlit and the model packages are imported when the program runs, so
+importing this module stays cheap (see REBooT_batch.py for headless runs).
 """
 import os
-import REBooT
-import REBooT.rundfunk as R
-import streamlit as st
+import tempfile
 
 
-def REBooT_program(programs=('icerisk',))):
+def REBooT_program(programs=('icerisk', 'icerisk park')):
+     import streamlit as st
      st.sidebar.header('Configuration (from env)')
      redis_url = st.sidebar.selectbox('REDIS_URL', (os.environ.get('REDIS_URL',None),))
      reboot_config = st.sidebar.selectbox('REBooT_config', (os.environ.get('REBooT_config', None),))
      reboot_section = st.sidebar.selectbox('REBooT_section', (os.environ.get('REBooT_section', None),))
      database_url = st.sidebar.selectbox('DATABASE_URL', (os.environ.get('DATABASE_URL', ':memory'), ':memory:'))
+     kernel_cache = st.sidebar.selectbox('REBooT_kernel_cache', (os.environ.get('REBooT_kernel_cache', None),))
+     metrics_file = st.sidebar.selectbox('REBooT_metrics', (os.environ.get('REBooT_metrics', None),))
+     trace_memory = st.sidebar.checkbox('Trace memory (slower)',
+                                        os.environ.get('REBooT_trace_memory', '').lower() in ('1', 'true', 'yes'))
+     workers = st.sidebar.number_input('Park workers', min_value=1, value=os.cpu_count() or 1)
      option = st.sidebar.selectbox(
           'Which program do you want to run?',
           programs)
      st.write('You selected:', option)
+     from REBooT_metrics import Profiler
+     with Profiler(trace_memory) as profiler:
+          try:
+               run_program(st, option, redis_url, reboot_config, reboot_section, kernel_cache, workers)
+          finally:
+               show_metrics(st, profiler, metrics_file, program=option, section=reboot_section or '')
+
+
+def run_program(st, option, redis_url, reboot_config, reboot_section, kernel_cache, workers):
+     from REBooT_metrics import stage
      if option == 'icerisk' and reboot_section is not None:
           try:
-               import icerisk.model
+               with stage('import'):
+                    import REBooT.rundfunk as R
+                    import icerisk.model
           except:
                st.error('icerisk is not installed')
                return
           try:
-               r = get_runner(reboot_section)
+               with stage('get_runner'):
+                    r = get_runner(reboot_section)
           except Exception as e:
                st.error(e)
                return 
-          R.test_streamlit()
+          with stage('run'):
+               R.test_streamlit()
+     elif option == 'icerisk park' and reboot_config is not None and reboot_section is not None:
+          with stage('import'):
+               import REBooT_park
+               from risk_analysis_cache import KernelCache, shared_run_cache
+          cache = None
+          if kernel_cache is not None:
+               cache = KernelCache(kernel_cache)
+          results = shared_run_cache(redis_url)
+          # the page only shows a summary, the raster goes with the temporary directory
+          with st.spinner(f'Running {reboot_section} on {workers} workers'), \
+                    tempfile.TemporaryDirectory() as raster_dir:
+               try:
+                    with stage('run'):
+                         grid, landed = REBooT_park.run_configured(reboot_config, reboot_section,
+                                                                   workers=int(workers), cache=cache,
+                                                                   results=results, raster_dir=raster_dir)
+               except Exception as e:
+                    st.error(e)
+                    return
+               total = float(landed.sum())
+          st.write(f'{total:.0f} fragments landed within the {grid.nx}x{grid.ny} grid '
+                   f'({grid.resolution:g} m resolution)')
+          st.sidebar.write(f'Run cache: {results.backend}')
+          if results.error:
+               st.sidebar.warning(results.error)
+          if cache is not None:
+               st.sidebar.write(f'Kernel cache: {cache.hits} hits, {cache.misses} misses')
+
+
+def show_metrics(st, profiler, metrics_file=None, **labels):
+     """Stage timings in the sidebar, downloadable and written to metrics_file (replacing it) as Prometheus text"""
+     if not profiler.stages:
+          return
+     st.sidebar.header('Stages')
+     st.sidebar.table([dict(stage=s['stage'], seconds=round(s['seconds'], 3),
+                            MB=round(s['peak_bytes'] / 2**20, 1) if 'peak_bytes' in s else None,
+                            status=s['status'])
+                       for s in profiler.stages])
+     metrics = profiler.to_prometheus(**labels)
+     st.sidebar.download_button('Download metrics', metrics, 'reboot_metrics.prom')
+     if metrics_file:
+          with open(metrics_file, 'w') as f:
+               f.write(metrics)
 
 if __name__ == '__main__':
      
      REBooT_program()
 
 def test_icerisk():
-     os.environ.update({'REBooT_section': 
-                        '' 
-     })
\ No newline at end of file
+     from streamlit.testing.v1 import AppTest
+     from REBooT_park import _write_test_park
+     os.environ.update({'REBooT_config': _write_test_park(tempfile.mkdtemp()),
+                        'REBooT_section': 'test'
+     })
+     at = AppTest.from_string('from REBooT_app import REBooT_program\nREBooT_program()', default_timeout=60)
+     at.run()
+     at.sidebar.selectbox[-1].select('icerisk park').run()
+     assert not at.exception
+     assert any('fragments landed' in m.value for m in at.main.markdown)
+     stages = at.sidebar.table[0].value['stage'].tolist()
+     assert {'run', 'run/load_park', 'run/shards'} <= set(stages)
\ No newline at end of file
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Headless batch runner for REBooT park sections
+
+Runs many REBooT_section's of a REBooT_config file without Streamlit, e.g.
+from cron or a job queue, and writes one JSON line per section:
+
+    python REBooT_batch.py parks.ini park_a park_b --workers 4 --out runs.jsonl
+
+Without sections every section of the config file is run. Heavy packages
+(NumPy and the model modules) are imported only once there is work to do,
+so --help and argument errors return immediately.
+"""
+__author__ = 'Rolv.Bredesen'
+
+import argparse
+import configparser
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', nargs='?', default=os.environ.get('REBooT_config'),
+                        help='REBooT_config file (default: $REBooT_config)')
+    parser.add_argument('sections', nargs='*', help='sections to run (default: all)')
+    parser.add_argument('--workers', type=int, default=None, help='process pool size (default: all cores)')
+    parser.add_argument('--kernel-cache', default=os.environ.get('REBooT_kernel_cache'),
+                        help='landing kernel cache directory (default: $REBooT_kernel_cache)')
+    parser.add_argument('--redis-url', default=os.environ.get('REDIS_URL'),
+                        help='run result cache (default: $REDIS_URL)')
+    parser.add_argument('--raster-dir', default=os.environ.get('REBooT_raster_dir'),
+                        help='keep the landed fragments per cell rasters, <section>-<run key>-<random>.npy, '
+                        'in this directory (default: $REBooT_raster_dir, else they are deleted after the run)')
+    parser.add_argument('--trace-memory', action='store_true', default=None,
+                        help='record the peak memory of every stage, slower (default: $REBooT_trace_memory)')
+    parser.add_argument('--out', default='-', help='JSON lines output file (default: stdout)')
+    args = parser.parse_args(argv)
+    if args.config is None:
+        parser.error('no config file given and REBooT_config is not set')
+    return args
+
+
+def run_section(config, section, workers=None, cache=None, results=None, raster_dir=None,
+                trace_memory=None):
+    """Run one park section and summarize it as a JSON serializable dict"""
+    import REBooT_park
+    from REBooT_metrics import Profiler
+
+    raster_dir = raster_dir or os.environ.get('REBooT_raster_dir')
+    # without a raster directory the raster is only needed for the summary
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.perf_counter()
+        with Profiler(trace_memory) as profiler:
+            grid, landed = REBooT_park.run_configured(config, section, workers=workers, cache=cache,
+                                                      results=results, raster_dir=raster_dir or tmp)
+        record = dict(section=section, status='ok', seconds=round(time.perf_counter() - t0, 3),
+                      grid=grid._asdict(), fragments_landed=float(landed.sum()),
+                      max_per_cell=float(landed.max()),
+                      max_per_m2=float(landed.max() / grid.cell_area),
+                      stages=profiler.stages)
+        if raster_dir:
+            record['raster'] = landed.filename
+    return record
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    parser = configparser.ConfigParser(inline_comment_prefixes=('#', ';'))
+    if not parser.read(args.config):
+        print(f'cannot read {args.config}', file=sys.stderr)
+        return 2
+    sections = args.sections or parser.sections()
+
+    from risk_analysis_cache import KernelCache, RunCache
+    cache = KernelCache(args.kernel_cache) if args.kernel_cache else None
+    results = RunCache(args.redis_url)
+    if results.error:
+        print(f'warning: {results.error}, run results are cached in this process only', file=sys.stderr)
+
+    out = sys.stdout if args.out == '-' else open(args.out, 'a')
+    failed = 0
+    try:
+        for section in sections:
+            try:
+                record = run_section(args.config, section, args.workers, cache, results, args.raster_dir,
+                                     args.trace_memory)
+            except Exception as e:
+                # keep going, one broken section should not stop a nightly batch
+                failed += 1
+                record = dict(section=section, status='error', error=f'{type(e).__name__}: {e}')
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
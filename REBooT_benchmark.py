@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the icerisk pipeline and UIs
+
+Times the hot paths with fixed seeds and sizes and stores the results as a
+JSON baseline, so two versions (or machines) can be compared:
+
+    python REBooT_benchmark.py run --out baseline.json
+    git checkout my-branch
+    python REBooT_benchmark.py run --out branch.json
+    python REBooT_benchmark.py compare baseline.json branch.json --tolerance 0.1
+
+compare exits with 1 when a benchmark lost more than tolerance of its
+throughput or grew its peak memory by more than tolerance. The park
+benchmark also stores the timing of every REBooT_metrics stage of the run,
+so a slower park run can be traced to a stage.
+"""
+__author__ = 'Rolv.Bredesen'
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARKS = {}
+
+
+def benchmark(unit):
+    """
+    Register a benchmark. The function gets a scale factor and a scratch
+    directory and returns (run, items): run() is the timed code and items the
+    number of unit it processes per call.
+    """
+    def register(setup):
+        BENCHMARKS[setup.__name__] = (setup, unit)
+        return setup
+    return register
+
+
+@benchmark('fragments')
+def trajectory(scale, tmp):
+    from risk_analysis_uncertainty import Turbine, simulate_landing
+    n = int(2**18 * scale)
+    return lambda: simulate_landing(n, Turbine(), wind_speed=10., seed=1), n
+
+
+@benchmark('samples')
+def rasterize(scale, tmp):
+    from risk_analysis_maps import Grid, ProbabilityRaster
+    from risk_analysis_uncertainty import Turbine, simulate_landing
+    n = int(2**20 * scale)
+    landing = simulate_landing(n, Turbine(), wind_speed=10., seed=1)
+    raster = ProbabilityRaster.create(os.path.join(tmp, 'park.npy'), Grid(-1000., -1000., 2000, 2000, 1.))
+    return lambda: raster.add_landing('T1', landing, 0., 0., 100.), n
+
+
+@benchmark('cells')
+def risk(scale, tmp):
+    import numpy as np
+    from risk_analysis_individual_risk import create_strike_stack, individual_risk
+    from risk_analysis_maps import Grid
+    size = int(1000 * scale**0.5)
+    stack = create_strike_stack(os.path.join(tmp, 'stack.npy'), Grid(0., 0., size, size, 1.))
+    rng = np.random.default_rng(1)
+    for channel in range(stack.channels):
+        stack.data[channel] = rng.exponential(1e-6, (size, size))
+    exposure = rng.uniform(0, 1, (size, size)).astype(np.float32)
+    return lambda: individual_risk(stack, exposure, risk_reduction=50., tile_size=512), size * size
+
+
+@benchmark('elements')
+def nusap(scale, tmp):
+    import numpy as np
+    from strength_of_knowledge_judgment.NUSAP_pedigree import NUSAPStore, research_criteria
+    n = int(10**5 * scale)
+    rng = np.random.default_rng(1)
+    numerals = rng.uniform(1, 100, n)
+    columns = ([f'park {i}' for i in rng.integers(0, 100, n)], [f'input {i}' for i in range(n)],
+               numerals, ['kg/year'] * n, np.column_stack([0.8 * numerals, 1.2 * numerals]),
+               ['High > 90 %'] * n, rng.integers(0, 5, (n, len(research_criteria))))
+
+    def run():
+        store = NUSAPStore(research_criteria)
+        store.extend(*columns)
+        store.classify()
+        store.by_project()
+    return run, n
+
+
+@benchmark('reruns')
+def qc_rerun(scale, tmp):
+    from streamlit import logger
+    from streamlit.testing.v1 import AppTest
+    logger.set_log_level('error')  # bare mode warnings on every rerun
+    app = AppTest.from_string('import risk_analysis_qc\nrisk_analysis_qc.main()', default_timeout=60)
+    app.run()
+    return app.run, 1
+
+
+@benchmark('fragments')
+def park(scale, tmp):
+    import numpy as np
+    from REBooT_metrics import Profiler
+    import REBooT_park
+    rng = np.random.default_rng(1)
+    hours = int(200 * scale)
+    config = REBooT_park._write_test_park(
+        tmp, turbines=4, section='bench', resolution=5, hours_per_shard=50,
+        icing=np.column_stack([rng.weibull(2, hours) * 8, rng.uniform(0, 360, hours), np.full(hours, 10.)]))
+
+    def run():
+        with Profiler(trace_memory=False) as profiler:
+            REBooT_park.run_configured(config, 'bench', workers=1, raster_dir=tmp)
+        return {s['stage']: s['seconds'] for s in profiler.stages}
+    return run, 4 * hours * 1000
+
+
+def measure(name, scale=1., repeat=5):
+    """Run one benchmark, returns its result record"""
+    setup, unit = BENCHMARKS[name]
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            run, items = setup(scale, tmp)
+        except ImportError as e:
+            return dict(status='skipped', reason=str(e))
+        run()  # warm up: imports, caches, page faults
+        times, stages = [], []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            result = run()
+            times.append(time.perf_counter() - t0)
+            if isinstance(result, dict):
+                stages.append(result)
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    median = statistics.median(times)
+    record = dict(status='ok', unit=unit, items=items, repeat=repeat, seconds_median=median,
+                  seconds_min=min(times), throughput=items / median, peak_bytes=peak)
+    if stages:
+        record['stages'] = {k: statistics.median(s[k] for s in stages) for k in stages[0]}
+    return record
+
+
+def environment():
+    from risk_analysis_cache import code_version
+    import numpy as np
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(created=datetime.datetime.now().isoformat(timespec='seconds'), commit=commit,
+                code_version=code_version(), python=platform.python_version(), numpy=np.__version__,
+                machine=platform.machine(), processor=platform.processor(), cpus=os.cpu_count())
+
+
+def run_benchmarks(names=None, scale=1., repeat=5, log=sys.stderr):
+    results = {}
+    for name in names or BENCHMARKS:
+        results[name] = record = measure(name, scale, repeat)
+        if record['status'] == 'ok':
+            print(f"{name:12s} {record['throughput']:12.4g} {record['unit']}/s "
+                  f"{record['peak_bytes'] / 2**20:8.1f} MB", file=log)
+        else:
+            print(f"{name:12s} skipped: {record['reason']}", file=log)
+    return dict(environment(), scale=scale, benchmarks=results)
+
+
+def compare(baseline, current, tolerance=0.1):
+    """Rows (name, throughput ratio, memory ratio, regressed) for the benchmarks run in both"""
+    rows = []
+    for name, new in current['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None or old['status'] != 'ok' or new['status'] != 'ok':
+            continue
+        speed = new['throughput'] / old['throughput']
+        memory = new['peak_bytes'] / max(old['peak_bytes'], 1)
+        rows.append((name, speed, memory, speed < 1 - tolerance or memory > 1 + tolerance))
+        for stage, seconds in new.get('stages', {}).items():
+            before = old.get('stages', {}).get(stage)
+            if before:
+                rows.append((f'  {stage}', before / seconds, None, before / seconds < 1 - tolerance))
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run the benchmarks and write a baseline')
+    run.add_argument('names', nargs='*', help=f"benchmarks (default: all of {', '.join(BENCHMARKS)})")
+    run.add_argument('--scale', type=float, default=1., help='problem size factor')
+    run.add_argument('--repeat', type=int, default=5)
+    run.add_argument('--out', default='-', help='JSON baseline file (default: stdout)')
+    diff = commands.add_parser('compare', help='compare two baselines')
+    diff.add_argument('baseline')
+    diff.add_argument('current')
+    diff.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown')
+    args = parser.parse_args(argv)
+    unknown = set(getattr(args, 'names', ())) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'run':
+        results = json.dumps(run_benchmarks(args.names, args.scale, args.repeat), indent=1)
+        if args.out == '-':
+            print(results)
+        else:
+            with open(args.out, 'w') as f:
+                f.write(results)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline.get('scale') != current.get('scale'):
+        print(f"warning: scale {baseline.get('scale')} vs {current.get('scale')}", file=sys.stderr)
+    rows = compare(baseline, current, args.tolerance)
+    print(f"{'benchmark':24s} {'speed':>8s} {'memory':>8s}")
+    for name, speed, memory, regressed in rows:
+        memory = '' if memory is None else f'{memory:.2f}x'
+        print(f"{name:24s} {speed:7.2f}x {memory:>8s}{'  REGRESSION' if regressed else ''}")
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
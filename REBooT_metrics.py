@@ -0,0 +1,131 @@
+"""
+Timing and memory of the stages of a REBooT run
+
+Code marks its stages with `stage(name)`, which costs nothing unless a
+Profiler is active. The profiler records wall and CPU time. Memory tracing
+is opt-in (trace_memory=True or REBooT_trace_memory=1 in the environment),
+since tracemalloc slows NumPy heavy stages down about twofold. It records
+the peak of the memory allocated by Python and NumPy in each stage of this
+process. Nested stages are named by their path ('run/load_park').
+
+    with Profiler() as profiler:
+        REBooT_park.run_configured('parks.ini', 'mypark')
+    print(profiler.to_prometheus())
+
+Stages inside worker processes are not seen, their time counts towards the
+stage that waits for them. Such stages are marked with subprocesses=True and
+get no peak_bytes, as the memory of the workers is not traced.
+"""
+__author__ = 'Rolv.Bredesen'
+
+import contextlib
+import contextvars
+import json
+import os
+import time
+import tracemalloc
+
+_active = contextvars.ContextVar('REBooT_profiler', default=None)
+
+
+@contextlib.contextmanager
+def stage(name, subprocesses=False):
+    """Record the enclosed code as a stage of the active profiler, if any"""
+    profiler = _active.get()
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name, subprocesses):
+            yield
+
+
+def _label_value(value):
+    """Label value escaped for the Prometheus text format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Profiler:
+    def __init__(self, trace_memory=None):
+        if trace_memory is None:
+            trace_memory = os.environ.get('REBooT_trace_memory', '').lower() in ('1', 'true', 'yes')
+        self.trace_memory = trace_memory
+        self.stages = []  # dicts in the order the stages started
+        self._stack = []
+        self._token = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._token = _active.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _active.reset(self._token)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, name, subprocesses=False):
+        path = '/'.join([s['name'] for s in self._stack] + [name])
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        entry = dict(name=name, peak=0)
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            entry['start'] = current
+            tracemalloc.reset_peak()
+        self._stack.append(entry)
+        record = dict(stage=path, status='running')
+        if subprocesses:
+            record['subprocesses'] = True
+        self.stages.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+            record['status'] = 'ok'
+        except BaseException:
+            record['status'] = 'error'
+            raise
+        finally:
+            record.update(seconds=time.perf_counter() - wall, cpu_seconds=time.process_time() - cpu)
+            self._stack.pop()
+            if tracing:
+                # reset_peak is global, so the peak of a nested stage is handed to its parent
+                peak = max(tracemalloc.get_traced_memory()[1], entry['peak'])
+                if not subprocesses:
+                    record['peak_bytes'] = peak - entry['start']
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+                tracemalloc.reset_peak()
+
+    def to_json(self):
+        return json.dumps(self.stages)
+
+    def to_prometheus(self, prefix='reboot_stage', **labels):
+        """Prometheus text format, one sample per stage and measure"""
+        lines = []
+        measures = (('seconds', 'Wall time'), ('cpu_seconds', 'CPU time'), ('peak_bytes', 'Peak traced memory (this process)'))
+        for measure, help_text in measures:
+            rows = [s for s in self.stages if measure in s]
+            if not rows:
+                continue
+            lines += [f'# HELP {prefix}_{measure} {help_text} of a REBooT run stage',
+                      f'# TYPE {prefix}_{measure} gauge']
+            for s in rows:
+                label = ','.join(f'{k}="{_label_value(v)}"'
+                                 for k, v in dict(labels, stage=s['stage']).items())
+                lines.append(f'{prefix}_{measure}{{{label}}} {s[measure]:g}')
+        return '\n'.join(lines) + '\n'
+
+
+def test_prometheus_escapes_labels():
+    with Profiler() as profiler:
+        with stage('load'):
+            pass
+    text = profiler.to_prometheus(section='park "A"\\1\nB')
+    assert 'section="park \\"A\\"\\\\1\\nB",stage="load"' in text
+    assert len(text.splitlines()) == 6
@@ -0,0 +1,372 @@
+"""
+Park wide ice throw runs sharded over a process pool
+
+The work for a park is split by turbine and by chunks of icing hours. Every
+shard draws its random numbers from its own SeedSequence, derived from the
+run seed and the (turbine, chunk) position of the shard, and the partial
+landing histograms are merged in shard order. The result is therefore
+bit-identical for any number of workers.
+
+Park configuration (REBooT_config ini file, one section per park):
+
+    [mypark]
+    turbines = turbines.csv      # name,x,y,hub_height,rotor_diameter
+    icing_hours = icing.csv      # wind_speed,wind_direction,fragments
+    resolution = 5               # m
+    margin = 400                 # m around the outermost turbines
+    samples_per_hour = 1000
+    hours_per_shard = 100
+    mode = operating
+    dem = dem_tiles              # optional terrain (risk_analysis_terrain), same coordinates as x, y
+    speed_bin = 1                # m/s, wind bins when running from cached kernels
+    direction_bin = 10           # degrees
+    samples_per_bin = 100000
+"""
+__author__ = 'Rolv.Bredesen'
+
+import configparser
+import hashlib
+import itertools
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import numpy as np
+
+from REBooT_metrics import stage
+from risk_analysis_cache import code_version, content_key, landing_kernel, pack_result, unpack_result
+from risk_analysis_maps import Grid, ProbabilityRaster, strike_window
+from risk_analysis_uncertainty import Turbine, simulate_landing
+
+
+# the park runs count fragments, divide by grid.cell_area for fragments per m2
+LANDED_UNIT = 'fragments per cell over the icing hours'
+
+
+class ParkTurbine(NamedTuple):
+    name: str
+    x: float
+    y: float
+    turbine: Turbine
+
+
+class Shard(NamedTuple):
+    turbine_index: int
+    chunk_index: int
+    hours: slice
+
+
+def shards(n_turbines, n_hours, hours_per_shard):
+    """Fixed enumeration of the work, independent of the number of workers"""
+    return [Shard(t, c, slice(start, min(start + hours_per_shard, n_hours)))
+            for t in range(n_turbines)
+            for c, start in enumerate(range(0, n_hours, hours_per_shard))]
+
+
+def shard_seed(seed, shard):
+    return np.random.SeedSequence(seed, spawn_key=(shard.turbine_index, shard.chunk_index))
+
+
+def _run_shard(args):
+    park_turbine, hours, shard, grid, samples_per_hour, seed, model_kwargs = args
+    wind_speed, wind_direction, fragments = hours
+    n = len(wind_speed) * samples_per_hour
+    # every simulated fragment stands for fragments/samples_per_hour thrown fragments
+    hour = np.repeat(np.arange(len(wind_speed)), samples_per_hour)
+    landing = simulate_landing(n, park_turbine.turbine, wind_speed[hour], wind_direction[hour],
+                               seed=shard_seed(seed, shard), position=(park_turbine.x, park_turbine.y),
+                               per_fragment=True, **model_kwargs)
+    return strike_window(grid, park_turbine.x + landing.x, park_turbine.y + landing.y,
+                         landing.weight * fragments[hour] / samples_per_hour)
+
+
+def _merge_window(current, part):
+    """Sum of two (row, col, window) parts over the union of their windows"""
+    if current is None:
+        return part[0], part[1], np.array(part[2], dtype=float)
+    (r0, c0, a), (r1, c1, b) = current, part
+    row, col = min(r0, r1), min(c0, c1)
+    shape = (max(r0 + a.shape[0], r1 + b.shape[0]) - row, max(c0 + a.shape[1], c1 + b.shape[1]) - col)
+    if (row, col) != (r0, c0) or shape != a.shape:
+        grown = np.zeros(shape)
+        grown[r0 - row:r0 - row + a.shape[0], c0 - col:c0 - col + a.shape[1]] = a
+        a = grown
+    a[r1 - row:r1 - row + b.shape[0], c1 - col:c1 - col + b.shape[1]] += b
+    return row, col, a
+
+
+def add_turbine_windows(parts, park, out):
+    """
+    Sum the (turbine index, (row, col, window) or None) parts of a run into out.
+
+    Parts come in turbine order and are first summed per turbine. With a
+    ProbabilityRaster out, that sum becomes the turbine's window, so a rerun
+    replaces the earlier contribution of the turbine instead of adding to it.
+    """
+    for index, group in itertools.groupby(parts, key=lambda p: p[0]):
+        window = None
+        for _, part in group:
+            if part is not None:
+                window = _merge_window(window, part)
+        name = park[index].name
+        if isinstance(out, ProbabilityRaster):
+            if window is not None:
+                out.add(name, *window)
+            elif name in out.windows:
+                out.remove(name)
+        elif window is not None:
+            row, col, w = window
+            out[row:row + w.shape[0], col:col + w.shape[1]] += w
+    return out
+
+
+def run_park(park, icing, grid, samples_per_hour=1000, hours_per_shard=100, workers=None,
+             seed=0, out=None, **model_kwargs):
+    """
+    Expected number of fragments landing in each grid cell for the whole park
+    over the icing hours (LANDED_UNIT, not a probability per m2).
+
+    park is a list of ParkTurbine, icing a mapping of equally long hourly
+    arrays wind_speed, wind_direction and fragments (thrown per turbine and
+    hour). workers=None uses all cores, workers=1 runs in this process.
+    Shards only return the window their fragments land in. The windows of a
+    turbine are added to out (a risk_analysis_maps.ProbabilityRaster, see
+    add_turbine_windows, or an array of the grid shape) or to a new in-memory
+    array, which is returned. Extra keyword arguments are passed on to
+    simulate_landing.
+    """
+    icing = [np.asarray(icing[k], dtype=float) for k in ('wind_speed', 'wind_direction', 'fragments')]
+    # only the hours of its shard are sent to a worker
+    jobs = [(park[s.turbine_index], [series[s.hours] for series in icing], s, grid, samples_per_hour,
+             seed, model_kwargs)
+            for s in shards(len(park), len(icing[0]), hours_per_shard)]
+    out = np.zeros(grid.shape) if out is None else out
+    turbines = [job[2].turbine_index for job in jobs]
+    if workers == 1:
+        return add_turbine_windows(zip(turbines, map(_run_shard, jobs)), park, out)
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        # map yields in submission order, so the sum is the same for any pool size
+        parts = pool.map(_run_shard, jobs, chunksize=max(1, len(jobs) // (4 * workers)))
+        return add_turbine_windows(zip(turbines, parts), park, out)
+
+
+def wind_bins(icing, speed_bin=1., direction_bin=10.):
+    """Fragments thrown per (wind speed, wind direction) bin centre"""
+    speed = (np.floor(np.asarray(icing['wind_speed']) / speed_bin) + 0.5) * speed_bin
+    direction = np.round(np.asarray(icing['wind_direction']) / direction_bin) * direction_bin % 360
+    bins, inverse = np.unique(np.stack([speed, direction], axis=1), axis=0, return_inverse=True)
+    fragments = np.bincount(inverse.ravel(), weights=icing['fragments'], minlength=len(bins))
+    return bins[:, 0], bins[:, 1], fragments
+
+
+def run_park_kernels(park, icing, grid, cache=None, speed_bin=1., direction_bin=10.,
+                     samples_per_bin=100_000, out=None, **model_kwargs):
+    """
+    Like run_park, but from landing kernels per turbine and wind bin.
+
+    Icing hours are lumped into wind bins and every (turbine, bin) kernel is
+    looked up in cache (a risk_analysis_cache.KernelCache) before simulating.
+    Reruns with unchanged trajectory inputs therefore skip the Monte Carlo
+    simulation entirely.
+    """
+    speeds, directions, fragments = wind_bins(icing, speed_bin, direction_bin)
+
+    def parts():
+        for index, t in enumerate(park):
+            offset = ((t.x - grid.x0) % grid.resolution, (t.y - grid.y0) % grid.resolution)
+            yield index, None
+            for speed, direction, n in zip(speeds, directions, fragments):
+                kgrid, kernel = landing_kernel(t.turbine, speed, direction, grid.resolution, offset,
+                                               samples_per_bin, cache, **model_kwargs)
+                row = int(round((t.y + kgrid.y0 - grid.y0) / grid.resolution))
+                col = int(round((t.x + kgrid.x0 - grid.x0) / grid.resolution))
+                # clip the kernel to the park grid
+                r0, c0 = max(row, 0), max(col, 0)
+                r1, c1 = min(row + kgrid.ny, grid.ny), min(col + kgrid.nx, grid.nx)
+                if r0 < r1 and c0 < c1:
+                    yield index, (r0, c0, n * kernel[r0 - row:r1 - row, c0 - col:c1 - col])
+
+    return add_turbine_windows(parts(), park, np.zeros(grid.shape) if out is None else out)
+
+
+def load_park(config_file, section):
+    """Read park layout and icing hours for a section of a REBooT_config file"""
+    config = configparser.ConfigParser(inline_comment_prefixes=('#', ';'))
+    if not config.read(config_file):
+        raise FileNotFoundError(config_file)
+    cfg = config[section]
+    root = os.path.dirname(os.path.abspath(config_file))
+    turbines = np.genfromtxt(os.path.join(root, cfg['turbines']), delimiter=',', names=True,
+                             dtype=None, encoding='utf-8')
+    park = [ParkTurbine(str(t['name']), float(t['x']), float(t['y']),
+                        Turbine(hub_height=float(t['hub_height']), rotor_diameter=float(t['rotor_diameter'])))
+            for t in np.atleast_1d(turbines)]
+    hours = np.atleast_1d(np.genfromtxt(os.path.join(root, cfg['icing_hours']), delimiter=',', names=True))
+    icing = {k: hours[k] for k in ('wind_speed', 'wind_direction', 'fragments')}
+    grid = Grid.around([t.x for t in park], [t.y for t in park],
+                       cfg.getfloat('margin', 400.), cfg.getfloat('resolution', 5.))
+    options = dict(samples_per_hour=cfg.getint('samples_per_hour', 1000),
+                   hours_per_shard=cfg.getint('hours_per_shard', 100),
+                   speed_bin=cfg.getfloat('speed_bin', 1.),
+                   direction_bin=cfg.getfloat('direction_bin', 10.),
+                   samples_per_bin=cfg.getint('samples_per_bin', 100_000),
+                   mode=cfg.get('mode', 'operating'))
+    if 'dem' in cfg:
+        from risk_analysis_terrain import DEM
+        options['terrain'] = DEM(os.path.join(root, cfg['dem']))
+    return park, icing, grid, options
+
+
+def run_key(config_file, section, **extra):
+    """Hash of a park section, the files (and DEM tiles) it refers to and the code version"""
+    config = configparser.ConfigParser(inline_comment_prefixes=('#', ';'))
+    if not config.read(config_file):
+        raise FileNotFoundError(config_file)
+    cfg = dict(config[section])
+    root = os.path.dirname(os.path.abspath(config_file))
+    files = {}
+    for name in ('turbines', 'icing_hours'):
+        with open(os.path.join(root, cfg[name]), 'rb') as f:
+            files[name] = hashlib.sha256(f.read()).hexdigest()
+    if 'dem' in cfg:
+        from risk_analysis_terrain import DEM
+        files['dem'] = DEM(os.path.join(root, cfg['dem'])).fingerprint()
+    return content_key(section=cfg, files=files, version=code_version(), **extra)
+
+
+def _windows(out):
+    """Result of a run as {turbine: (row, col, window)}, one window of the landed area for arrays"""
+    if isinstance(out, ProbabilityRaster):
+        return {name: out.window(name) for name in out.windows}
+    rows, cols = np.nonzero(np.any(out, axis=1)), np.nonzero(np.any(out, axis=0))
+    if not len(rows[0]):
+        return {}
+    r0, r1, c0, c1 = rows[0][0], rows[0][-1] + 1, cols[0][0], cols[0][-1] + 1
+    return {'': (int(r0), int(c0), np.asarray(out[r0:r1, c0:c1]))}
+
+
+def _add_windows(out, windows):
+    for name, (row, col, window) in windows.items():
+        if isinstance(out, ProbabilityRaster):
+            out.add(name, row, col, window)
+        else:
+            out[row:row + window.shape[0], col:col + window.shape[1]] += window
+
+
+def run_configured(config_file, section, workers=None, cache=None, out=None, results=None,
+                   raster_dir=None):
+    """
+    Load a park section and run it, returning (grid, landed fragments per cell).
+
+    With a KernelCache the run goes through run_park_kernels, otherwise the
+    hourly Monte Carlo run is sharded over workers processes. results is an
+    optional risk_analysis_cache.RunCache checked before running anything.
+
+    The landed fragments are added to out, a ProbabilityRaster or an array of
+    the grid shape. By default every run creates its own memory mapped raster
+    <section>-<run key>-<random>.npy in raster_dir (default $REBooT_raster_dir
+    or the temp directory), so the park never has to fit in memory and
+    concurrent runs of a section never share files. landed is the data of
+    the raster (or out itself) in LANDED_UNIT, which is also recorded in the
+    raster's attrs['unit']. The raster files belong to the caller, who
+    deletes them (risk_analysis_maps.delete_raster) or runs into a
+    temporary directory.
+    """
+    with stage('run_key'):
+        key = run_key(config_file, section, kernels=cache is not None)
+    hit = None
+    if results is not None:
+        with stage('run_cache_get'):
+            hit = results.get(key)
+    if hit is not None:
+        grid, windows = unpack_result(hit)
+        out = _default_raster(out, raster_dir, section, key, grid)
+        _add_windows(out, windows)
+        return grid, out.data if isinstance(out, ProbabilityRaster) else out
+    with stage('load_park'):
+        park, icing, grid, options = load_park(config_file, section)
+    out = _default_raster(out, raster_dir, section, key, grid)
+    hourly = {k: options.pop(k) for k in ('samples_per_hour', 'hours_per_shard')}
+    binned = {k: options.pop(k) for k in ('speed_bin', 'direction_bin', 'samples_per_bin')}
+    if cache is not None and 'terrain' not in options:
+        with stage('kernels'):
+            run_park_kernels(park, icing, grid, cache, out=out, **binned, **options)
+    else:
+        with stage('shards', subprocesses=workers != 1):
+            run_park(park, icing, grid, workers=workers, out=out, **hourly, **options)
+    if results is not None:
+        with stage('run_cache_set'):
+            results.set(key, pack_result(grid, _windows(out)))
+    return grid, out.data if isinstance(out, ProbabilityRaster) else out
+
+
+def _default_raster(out, raster_dir, section, key, grid):
+    if out is not None:
+        return out
+    if raster_dir is None:
+        raster_dir = os.environ.get('REBooT_raster_dir') or os.path.join(tempfile.gettempdir(), 'REBooT_rasters')
+    os.makedirs(raster_dir, exist_ok=True)
+    # a file of its own, ProbabilityRaster.create truncates an existing raster
+    fd, path = tempfile.mkstemp('.npy', f'{section}-{key[:12]}-', raster_dir)
+    os.close(fd)
+    return ProbabilityRaster.create(path, grid, unit=LANDED_UNIT)
+
+
+def _test_park():
+    park = [ParkTurbine('T1', 0., 0., Turbine()), ParkTurbine('T2', 500., 0., Turbine())]
+    return park, Grid.around([0., 500.], [0., 0.], 400., 10.)
+
+
+def _write_test_park(root, turbines=1, icing=None, section='test', **options):
+    """
+    Park files (turbines.csv, icing.csv, parks.ini) for tests and benchmarks.
+
+    turbines are spaced 400 m along x, icing is an array of (wind_speed,
+    wind_direction, fragments) rows and options the extra keys of the
+    section. Returns the path of parks.ini.
+    """
+    if icing is None:
+        icing = [[8., 270., 10.], [4., 90., 5.]]
+    with open(os.path.join(root, 'turbines.csv'), 'w') as f:
+        f.write('name,x,y,hub_height,rotor_diameter\n')
+        f.writelines(f'T{i + 1},{400 * i},0,100,120\n' for i in range(turbines))
+    np.savetxt(os.path.join(root, 'icing.csv'), np.asarray(icing, dtype=float), delimiter=',',
+               header='wind_speed,wind_direction,fragments', comments='')
+    options = dict(dict(resolution=10, samples_per_hour=1000), **options)
+    config = os.path.join(root, 'parks.ini')
+    with open(config, 'w') as f:
+        f.write(f'[{section}]\nturbines = turbines.csv\nicing_hours = icing.csv\n')
+        f.writelines(f'{k} = {v}\n' for k, v in options.items())
+    return config
+
+
+def test_fragments_follow_their_hour():
+    # strong westerlies throw all the ice, calm easterly hours throw none
+    park, grid = _test_park()
+    icing = dict(wind_speed=np.repeat([20., 2.], 50), wind_direction=np.repeat([270., 90.], 50),
+                 fragments=np.repeat([1., 0.], 50))
+    landed = run_park(park[:1], icing, grid, samples_per_hour=200, hours_per_shard=30, workers=1)
+    x, _ = grid.cell_centers()
+    assert np.isclose(landed.sum(), 50.)
+    assert landed[:, x[0] < 0].sum() < 0.01 * landed.sum()
+
+
+def test_same_result_for_any_number_of_workers():
+    park, grid = _test_park()
+    rng = np.random.default_rng(0)
+    icing = dict(wind_speed=rng.uniform(2, 20, 90), wind_direction=rng.uniform(0, 360, 90),
+                 fragments=rng.integers(0, 10, 90))
+    serial = run_park(park, icing, grid, samples_per_hour=100, hours_per_shard=20, workers=1)
+    pooled = run_park(park, icing, grid, samples_per_hour=100, hours_per_shard=20, workers=2)
+    assert np.array_equal(serial, pooled)
+
+
+def test_runs_of_a_section_get_their_own_raster():
+    _, grid = _test_park()
+    root = tempfile.mkdtemp()
+    first = _default_raster(None, root, 'park', 'key', grid)
+    first.add('T1', 0, 0, np.ones((2, 2)))
+    second = _default_raster(None, root, 'park', 'key', grid)
+    assert first.path != second.path and first.data.sum() == 4
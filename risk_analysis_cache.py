@@ -0,0 +1,428 @@
+"""
+Caches for the icerisk pipeline
+
+## Landing kernels
+
+A landing kernel is the strike probability per cell for one fragment thrown
+from a turbine in one wind bin. It only depends on the trajectory inputs
+(turbine geometry, wind bin, fragment class and model settings), so reruns
+that change exposure, probit functions or barriers reuse the kernels instead
+of repeating the Monte Carlo simulation.
+
+Kernels are stored as .npz files named by the sha256 of their inputs and the
+version of the trajectory model. The cache is bounded in bytes and evicts the
+least recently used kernels (access time is kept in the file mtime).
+
+## Run results
+Completed park runs are stored in Redis (REDIS_URL) under a hash of the
+REBooT_config section, the files it refers to and the code version, with a
+TTL. A second analyst or a Streamlit rerun of the same configuration gets the
+stored result. Without Redis the most recent results are kept in the running
+process, up to a memory budget.
+"""
+__author__ = 'Rolv.Bredesen'
+
+import collections
+import dataclasses
+import functools
+import hashlib
+import inspect
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import risk_analysis_uncertainty
+from risk_analysis_maps import Grid
+
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+@functools.lru_cache(maxsize=None)
+def model_version():
+    """
+    Short hash of the code a kernel depends on, part of every kernel key.
+
+    Only the trajectory model and the binning are hashed, so editing other
+    parts of those modules (e.g. the uncertainty propagation) keeps the kernels.
+    """
+    m = risk_analysis_uncertainty
+    digest = hashlib.sha256(repr((m.GRAVITY, m.ICE_DENSITY)).encode())
+    for code in (m.Turbine, m.LandingSamples, m._wind, m._power_law_pdf, m.sample_release,
+                 m.integrate_trajectories, m._to_map, m.simulate_landing,
+                 Grid.around, Grid.cell_index, Grid.histogram, landing_kernel):
+        digest.update(inspect.getsource(code).encode())
+    return digest.hexdigest()[:12]
+
+
+def _canonical(value):
+    if dataclasses.is_dataclass(value):
+        return {'type': type(value).__name__, **dataclasses.asdict(value)}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (tuple, list)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    return value
+
+
+def content_key(**params):
+    """sha256 of the parameters in canonical json form"""
+    text = json.dumps(_canonical(params), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class KernelCache:
+    """
+    Size bounded least recently used cache of kernels on disk.
+
+    >>> cache = KernelCache(tempfile.mkdtemp(), max_bytes=10_000)
+    >>> cache.put('a', Grid(0, 0, 2, 2, 1.), np.ones((2, 2)))
+    >>> float(cache.get('a')[1].sum())
+    4.0
+    >>> cache.get('b') is None
+    True
+
+    The size of the cache is kept as a running total, the directory is only
+    scanned when the total goes over max_bytes. Eviction then goes down to
+    low_water * max_bytes, so a full cache is not rescanned on every put.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.hits = self.misses = 0
+        self._bytes = None  # running total, None until the first scan
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def get(self, key):
+        """(grid, kernel) or None, marking the entry as recently used"""
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                x0, y0, nx, ny, resolution = f['grid'].tolist()
+                kernel = f['kernel']
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return Grid(x0, y0, int(nx), int(ny), resolution), kernel
+
+    def put(self, key, grid, kernel):
+        # write to a temporary file and rename, readers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, grid=np.array(grid, dtype=float), kernel=kernel)
+            size = f.tell()
+        try:
+            size -= os.path.getsize(self._path(key))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, self._path(key))
+        if self._bytes is None or self._bytes + size > self.max_bytes:
+            self.evict()
+        else:
+            self._bytes += size
+
+    def evict(self):
+        """
+        Remove least recently used kernels until the cache fits in max_bytes
+        (or low_water of it when there is something to evict).
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        limit = self.max_bytes if total <= self.max_bytes else self.low_water * self.max_bytes
+        for _, size, path in sorted(entries):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._bytes = total
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                os.remove(entry.path)
+        self._bytes = 0
+
+
+def landing_kernel(turbine, wind_speed, wind_direction, resolution, offset=(0., 0.),
+                   samples=100_000, cache=None, **model_kwargs):
+    """
+    Strike probability per cell for one fragment thrown in a wind bin.
+
+    The kernel grid has the given resolution and is positioned relative to the
+    tower. offset is the position of the tower inside its park grid cell, so a
+    kernel can be added to the park raster without resampling. The Monte Carlo
+    seed is derived from the inputs, so a kernel is reproducible whether it
+    comes from the cache or not. Returns (grid, kernel).
+    """
+    params = dict(turbine=turbine, wind_speed=float(wind_speed), wind_direction=float(wind_direction),
+                  resolution=float(resolution), offset=[float(o) for o in offset],
+                  samples=int(samples), model=model_kwargs, version=model_version())
+    key = content_key(**params)
+    if cache is not None:
+        hit = cache.get(key)
+        if hit is not None:
+            return hit
+    landing = risk_analysis_uncertainty.simulate_landing(
+        samples, turbine, wind_speed, wind_direction, seed=int(key[:16], 16), **model_kwargs)
+    # grid aligned with the park cells: tower at offset from a cell corner
+    x, y = landing.x + offset[0], landing.y + offset[1]
+    local = Grid.around(x, y, resolution, resolution)
+    kernel = local.histogram(x, y, landing.weight) / samples
+    grid = Grid(local.x0 - offset[0], local.y0 - offset[1], local.nx, local.ny, local.resolution)
+    if cache is not None:
+        cache.put(key, grid, kernel)
+    return grid, kernel
+
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """Short hash of the sources of the icerisk pipeline modules, part of every run key"""
+    import REBooT_park
+    import risk_analysis_maps
+    import risk_analysis_terrain
+    digest = hashlib.sha256()
+    # this module too, landing_kernel makes the kernels of cached park runs
+    for module in (risk_analysis_uncertainty, risk_analysis_maps, risk_analysis_terrain, REBooT_park,
+                   sys.modules[__name__]):
+        digest.update(inspect.getsource(module).encode())
+    return digest.hexdigest()[:12]
+
+
+def pack_result(grid, windows):
+    """
+    Run result as bytes, for storing in the run cache.
+
+    windows maps turbine names to the (row, col, window) they landed in, so
+    only the landed area is stored, not the whole park grid.
+    """
+    buffer = io.BytesIO()
+    names = list(windows)
+    np.savez(buffer, grid=np.array(grid, dtype=float), names=np.array(json.dumps(names)),
+             offsets=np.array([windows[n][:2] for n in names], dtype=np.int64).reshape(-1, 2),
+             **{f'window{i}': windows[n][2] for i, n in enumerate(names)})
+    return buffer.getvalue()
+
+
+def unpack_result(data):
+    """(grid, windows) of a packed result"""
+    with np.load(io.BytesIO(data)) as f:
+        x0, y0, nx, ny, resolution = f['grid'].tolist()
+        names = json.loads(str(f['names']))
+        windows = {n: (int(row), int(col), f[f'window{i}'])
+                   for i, (n, (row, col)) in enumerate(zip(names, f['offsets']))}
+        return Grid(x0, y0, int(nx), int(ny), resolution), windows
+
+
+class LocalRuns:
+    """
+    Run results kept in this process: least recently used results are
+    dropped beyond max_bytes, expired ones when they are read.
+    """
+
+    def __init__(self, max_bytes=256 * 1024**2):
+        self.max_bytes = max_bytes
+        self._items = collections.OrderedDict()  # key -> (expiry time, value)
+        self._bytes = 0
+        self._lock = threading.Lock()  # Streamlit sessions run in threads
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            expiry, value = self._items.get(key, (0, None))
+            if value is None:
+                return None
+            if expiry < time.time():
+                self._pop(key)
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+            if len(value) > self.max_bytes:
+                return
+            self._items[key] = (time.time() + ttl, value)
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._items)))
+
+    def _pop(self, key):
+        self._bytes -= len(self._items.pop(key)[1])
+
+
+# Fallback store shared by all RunCache instances in this process, so Streamlit
+# reruns hit the cache even without Redis
+_local_runs = LocalRuns()
+
+
+class RunCache:
+    """
+    Completed runs in Redis, with an in-process fallback.
+
+    redis_url is the REDIS_URL from the environment. A client with the redis
+    get/set interface can be given directly instead (e.g. a local stand-in in
+    tests). While Redis is not reachable, results are kept in this process
+    only, and a connection to redis_url is retried every retry_interval
+    seconds. A Redis error in get or set never fails the run, error tells
+    why the last connection attempt failed (e.g. redis not installed).
+
+    >>> cache = RunCache(None, ttl=60)
+    >>> cache.set('k', b'result')
+    >>> cache.get('k')
+    b'result'
+    """
+
+    def __init__(self, redis_url=None, ttl=7 * 24 * 3600, client=None, prefix='REBooT:run:',
+                 retry_interval=60.):
+        self.redis_url = redis_url
+        self.ttl = ttl
+        self.prefix = prefix
+        self.client = client
+        self.retry_interval = retry_interval
+        self._retry_at = 0.
+        self.error = None
+        if client is None and redis_url:
+            self._connect()
+
+    def _connect(self):
+        try:
+            import redis
+        except ImportError:
+            self.error = 'REDIS_URL is set, but the redis package is not installed'
+            self._failed()
+            return
+        try:
+            client = redis.Redis.from_url(self.redis_url, socket_connect_timeout=1)
+            client.ping()
+            self.client, self.error = client, None
+        except Exception as e:
+            self.error = f'Redis is not reachable: {e}'
+            self._failed()
+
+    def _failed(self):
+        if self.redis_url:
+            self.client = None
+            self._retry_at = time.time() + self.retry_interval
+
+    def _redis(self):
+        if self.client is None and self.redis_url and time.time() >= self._retry_at:
+            self._connect()
+        return self.client
+
+    @property
+    def backend(self):
+        return 'redis' if self.client is not None else 'local'
+
+    def get(self, key):
+        client = self._redis()
+        if client is not None:
+            try:
+                value = client.get(self.prefix + key)
+                if value is not None:
+                    return value
+            except Exception:
+                self._failed()
+        # also results stored locally while Redis was down
+        return _local_runs.get(key)
+
+    def set(self, key, value):
+        client = self._redis()
+        if client is not None:
+            try:
+                client.set(self.prefix + key, value, ex=self.ttl)
+                return
+            except Exception:
+                self._failed()
+        _local_runs.set(key, value, self.ttl)
+
+
+@functools.lru_cache(maxsize=None)
+def shared_run_cache(redis_url=None):
+    """One RunCache per REDIS_URL and process, so reruns don't reconnect (it retries while Redis is down)"""
+    return RunCache(redis_url)
+
+
+class FakeRedis:
+    """Redis stand-in with get/set and expiry, failing every call when down"""
+
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def get(self, key):
+        if self.down:
+            raise ConnectionError('redis is down')
+        value, expiry = self.data.get(key, (None, None))
+        if expiry is not None and expiry < time.time():
+            del self.data[key]
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        if self.down:
+            raise ConnectionError('redis is down')
+        self.data[key] = (value, None if ex is None else time.time() + ex)
+
+
+def test_run_cache_with_redis_client():
+    client = FakeRedis()
+    cache = RunCache(client=client, ttl=60, prefix='test:')
+    assert cache.backend == 'redis' and cache.get('run') is None
+    cache.set('run', b'result')
+    assert cache.get('run') == b'result'
+    value, expiry = client.data['test:run']
+    assert abs(expiry - time.time() - 60) < 5
+    client.data['test:run'] = (value, time.time() - 1)  # the TTL has passed
+    assert cache.get('run') is None
+
+
+def test_run_cache_falls_back_when_redis_fails():
+    client = FakeRedis()
+    cache = RunCache(client=client, prefix='test:')
+    client.down = True
+    cache.set('outage', b'result')  # must not raise or lose the result
+    assert cache.get('outage') == b'result'
+    client.down = False
+    assert cache.get('outage') == b'result'
+
+
+def test_cache_hit_fills_out():
+    import REBooT_park
+    from risk_analysis_maps import ProbabilityRaster
+    root = tempfile.mkdtemp()
+    config = REBooT_park._write_test_park(root, turbines=2, samples_per_hour=500)
+    results = RunCache(client=FakeRedis())
+    grid, first = REBooT_park.run_configured(config, 'test', workers=1, results=results, raster_dir=root)
+    out = np.zeros(grid.shape)
+    _, hit = REBooT_park.run_configured(config, 'test', workers=1, results=results, out=out)
+    assert hit is out and np.allclose(out, first)
+    raster = ProbabilityRaster.create(os.path.join(root, 'out.npy'), grid)
+    REBooT_park.run_configured(config, 'test', results=results, out=raster)
+    assert np.array_equal(raster.data, first) and set(raster.windows) == {'T1', 'T2'}
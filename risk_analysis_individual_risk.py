@@ -0,0 +1,149 @@
+"""
+# Individual risk maps (IEA Wind Task 19 risk assessment step)
+
+Combines the layers of the risk step in prevalent_approach_for_risk_assessments.md
+  - strike probability maps from the trajectory model
+  - probability of persons present (exposure)
+  - vulnerability / probit function
+  - risk reduction factor of safety measures (e.g. 50 for warning systems and guards)
+  - thresholds for accepted risk levels
+
+into an individual risk map [1/year] and a raster of acceptance classes.
+
+Strike probabilities are kept as a stack of channels, one per ice type and
+impact energy class, since rime ice impacts are less dangerous than glaze ice
+of the same energy. The vulnerability is then only a weight per channel, so a
+new probit function, barrier or threshold re-scores a park by streaming the
+stack tile by tile, with memory bounded by the tile size.
+"""
+__author__ = 'Rolv.Bredesen'
+
+import math
+
+import numpy as np
+
+from risk_analysis_maps import ProbabilityRaster
+
+ICE_TYPES = ('rime', 'glaze')
+ENERGY_EDGES = (0., 10., 20., 40., 80., 150., 300., 600., 1200., 2500., np.inf)  # J
+ACCEPTANCE_THRESHOLDS = (1e-5, 1e-6, 1e-7)  # individual risk per year
+
+# Illustrative probit parameters, lethality = Phi((ln E - ln E50) / beta).
+# Conservative values should be used unless the uncertainty is specified.
+PROBIT = {'glaze': dict(e50=100., beta=0.6), 'rime': dict(e50=200., beta=0.6)}
+
+
+def _erf(x):
+    """Error function, Abramowitz and Stegun 7.1.26 (absolute error below 1.5e-7)"""
+    x = np.asarray(x, dtype=float)
+    t = 1 / (1 + 0.3275911 * np.abs(x))
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return np.sign(x) * (1 - poly * np.exp(-x * x))
+
+
+def lethality(energy, e50, beta):
+    """Log-normal probit: probability of fatality for an impact of energy [J]"""
+    energy = np.asarray(energy, dtype=float)
+    with np.errstate(divide='ignore'):
+        z = (np.log(energy) - math.log(e50)) / beta
+    return 0.5 * (1 + _erf(z / math.sqrt(2)))
+
+
+def energy_class(energy, edges=ENERGY_EDGES):
+    return np.clip(np.searchsorted(edges, energy, side='right') - 1, 0, len(edges) - 2)
+
+
+def create_strike_stack(path, grid, ice_types=ICE_TYPES, energy_edges=ENERGY_EDGES):
+    """Memory mapped strike probability stack with one channel per ice type and energy class"""
+    edges = [float(e) for e in energy_edges]
+    return ProbabilityRaster.create(path, grid, channels=len(ice_types) * (len(edges) - 1),
+                                    ice_types=list(ice_types), energy_edges=edges)
+
+
+def add_landing(stack, name, landing, x, y, fragments_per_year, ice_type):
+    """Add the landing samples of one turbine and ice type to the stack"""
+    ice_types, edges = stack.attrs['ice_types'], stack.attrs['energy_edges']
+    channel = ice_types.index(ice_type) * (len(edges) - 1) + energy_class(landing.impact_energy, edges)
+    stack.add_landing(f'{name}.{ice_type}', landing, x, y, fragments_per_year, channel)
+
+
+def channel_vulnerability(stack, probit=PROBIT):
+    """Lethality per channel, evaluated at the geometric centre of each energy class"""
+    edges = np.array(stack.attrs['energy_edges'])
+    lower = np.maximum(edges[:-1], 1.)
+    upper = np.where(np.isinf(edges[1:]), 2 * edges[:-1], edges[1:])
+    centre = np.sqrt(lower * upper)
+    return np.concatenate([lethality(centre, **probit[ice]) for ice in stack.attrs['ice_types']])
+
+
+def _window(layer, rows, cols):
+    """Tile of a raster layer, or the value itself for scalars"""
+    return layer[rows, cols] if np.ndim(layer) == 2 else layer
+
+
+def individual_risk(stack, exposure, vulnerability=None, risk_reduction=1., target_area=1.,
+                    thresholds=ACCEPTANCE_THRESHOLDS, out=None, acceptance=None, tile_size=1024):
+    """
+    Individual risk per year and acceptance class for every cell of a strike stack.
+
+    exposure is the probability of a person being present, risk_reduction the
+    risk reduction factor of the measures in place, both scalars or rasters of
+    the grid shape (e.g. memory mapped). vulnerability is the lethality per
+    channel (default channel_vulnerability(stack)) and target_area the area [m2]
+    a person exposes to falling ice. out and acceptance are optional arrays of
+    the grid shape to write into (e.g. np.lib.format.open_memmap). The
+    acceptance class is the number of thresholds the risk exceeds, a risk
+    equal to a threshold does not exceed it.
+
+    Returns (risk, acceptance, summary) with the maximum risk and the area
+    exceeding each threshold in summary.
+    """
+    grid = stack.grid
+    if vulnerability is None:
+        vulnerability = channel_vulnerability(stack)
+    weights = np.asarray(vulnerability, dtype=stack.data.dtype) * target_area
+    thresholds = np.sort(np.asarray(thresholds))
+    if out is None:
+        out = np.zeros(grid.shape, dtype=stack.data.dtype)
+    if acceptance is None:
+        acceptance = np.zeros(grid.shape, dtype=np.uint8)
+
+    max_risk = 0.
+    cells_above = np.zeros(len(thresholds), dtype=np.int64)
+    for rows, cols, tile in stack.tiles(tile_size):
+        risk = np.tensordot(weights, tile, axes=1)
+        if risk.any():
+            risk *= _window(exposure, rows, cols)
+            risk /= _window(risk_reduction, rows, cols)
+            level = np.searchsorted(thresholds, risk, side='left').astype(np.uint8)
+            max_risk = max(max_risk, float(risk.max()))
+            counts = np.bincount(level.ravel(), minlength=len(thresholds) + 1)
+            cells_above += counts[::-1].cumsum()[::-1][1:]
+        else:
+            level = 0
+        out[rows, cols] = risk
+        acceptance[rows, cols] = level
+    summary = dict(max_risk=max_risk,
+                   area_above={float(t): float(n * grid.cell_area) for t, n in zip(thresholds, cells_above)})
+    return out, acceptance, summary
+
+
+def test_lethality():
+    energy = np.geomspace(1., 5000., 50)
+    expected = [0.5 * (1 + math.erf((math.log(e) - math.log(100.)) / (0.6 * math.sqrt(2)))) for e in energy]
+    assert np.allclose(lethality(energy, 100., 0.6), expected, atol=1e-6)
+    assert lethality(0., 100., 0.6) == 0 and np.isclose(lethality(100., 100., 0.6), 0.5)
+
+
+def test_acceptance_classes_and_areas():
+    import tempfile
+    from risk_analysis_maps import Grid
+    stack = create_strike_stack(tempfile.mkdtemp() + '/stack.npy', Grid(0., 0., 3, 2, 2.))
+    stack.data[0] = [[1., 0.5, 0.375], [0.25, 0.125, 0.]]
+    vulnerability = np.zeros(stack.channels)
+    vulnerability[0] = 1.
+    risk, acceptance, summary = individual_risk(stack, 1., vulnerability, thresholds=(0.5, 0.25),
+                                                tile_size=2)
+    # equal to a threshold is not above it
+    assert acceptance.tolist() == [[2, 1, 1], [0, 0, 0]]
+    assert summary == dict(max_risk=1., area_above={0.25: 12., 0.5: 4.})
@@ -0,0 +1,245 @@
+"""
+# Probability maps of ice strike
+
+Landing samples from the trajectory model (risk_analysis_uncertainty) are binned
+into strike probability per m2 around each turbine and summed into one park
+raster. The park raster lives on disk as a memory mapped .npy file, so a
+10 km x 10 km park at 1 m resolution (400 MB in float32) never has to fit in
+RAM. Each turbine only touches the window its fragments land in, and its
+contribution is kept next to the raster so a turbine can be re-run and
+replaced without rebuilding the map.
+
+Files for a raster at park.npy:
+  - park.npy           memory mapped raster, strike probability [1/m2/year]
+                       when built by add_landing, other producers record
+                       their unit in attrs['unit']
+  - park.json          grid and the windows of the turbines added so far
+  - park.turbines/     the window of each turbine, for incremental updates
+"""
+__author__ = 'Rolv.Bredesen'
+
+import json
+import os
+import shutil
+from typing import NamedTuple
+
+import numpy as np
+
+
+class Grid(NamedTuple):
+    x0: float  # m, west edge
+    y0: float  # m, south edge
+    nx: int
+    ny: int
+    resolution: float  # m
+
+    @classmethod
+    def around(cls, x, y, margin, resolution):
+        """Grid covering the points x, y with margin metres to spare"""
+        x0 = np.floor((np.min(x) - margin) / resolution) * resolution
+        y0 = np.floor((np.min(y) - margin) / resolution) * resolution
+        nx = int(np.ceil((np.max(x) + margin - x0) / resolution))
+        ny = int(np.ceil((np.max(y) + margin - y0) / resolution))
+        return cls(float(x0), float(y0), nx, ny, float(resolution))
+
+    @property
+    def shape(self):
+        return self.ny, self.nx
+
+    @property
+    def cell_area(self):
+        return self.resolution**2
+
+    def cell_index(self, x, y):
+        """Row, column of the cells containing x, y (may be outside the grid)"""
+        col = np.floor((np.asarray(x) - self.x0) / self.resolution).astype(np.intp)
+        row = np.floor((np.asarray(y) - self.y0) / self.resolution).astype(np.intp)
+        return row, col
+
+    def cell_centers(self, rows=slice(None), cols=slice(None)):
+        """x, y of the cell centres in a window, as open (broadcastable) arrays"""
+        row = np.arange(self.ny)[rows]
+        col = np.arange(self.nx)[cols]
+        return (self.x0 + (col[None, :] + 0.5) * self.resolution,
+                self.y0 + (row[:, None] + 0.5) * self.resolution)
+
+    def histogram(self, x, y, weights=None, channel=None, n_channels=1):
+        """
+        Sum of weights per cell, points outside the grid are dropped.
+
+        With channel (an integer array like x), points are binned into a
+        (n_channels, ny, nx) stack instead of a single (ny, nx) map.
+        """
+        row, col = self.cell_index(x, y)
+        inside = (row >= 0) & (row < self.ny) & (col >= 0) & (col < self.nx)
+        flat = row[inside] * self.nx + col[inside]
+        if channel is not None:
+            flat += np.broadcast_to(channel, inside.shape)[inside] * (self.nx * self.ny)
+        if weights is not None:
+            weights = np.broadcast_to(weights, inside.shape)[inside]
+        counts = np.bincount(flat, weights=weights, minlength=n_channels * self.nx * self.ny)
+        shape = self.shape if channel is None else (n_channels,) + self.shape
+        return counts.astype(float).reshape(shape)
+
+    def window(self, x, y):
+        """
+        Smallest part of the grid containing the points x, y.
+
+        Returns (row, col, subgrid) where row, col is the offset of the
+        subgrid in this grid, or None when no point is inside.
+        """
+        row, col = self.cell_index(x, y)
+        inside = (row >= 0) & (row < self.ny) & (col >= 0) & (col < self.nx)
+        if not inside.any():
+            return None
+        r0, r1 = row[inside].min(), row[inside].max() + 1
+        c0, c1 = col[inside].min(), col[inside].max() + 1
+        return int(r0), int(c0), Grid(self.x0 + c0 * self.resolution, self.y0 + r0 * self.resolution,
+                                      int(c1 - c0), int(r1 - r0), self.resolution)
+
+    def tiles(self, tile_size=1024):
+        """Row and column slices covering the grid in square tiles"""
+        for r in range(0, self.ny, tile_size):
+            for c in range(0, self.nx, tile_size):
+                yield slice(r, min(r + tile_size, self.ny)), slice(c, min(c + tile_size, self.nx))
+
+
+def strike_window(grid, x, y, weights=None, channel=None, n_channels=1):
+    """
+    Histogram of landing points over only the window they fall in.
+
+    Returns (row, col, counts) with the last two axes of counts equal to the
+    window, or None when all points fall outside the grid.
+    """
+    window = grid.window(x, y)
+    if window is None:
+        return None
+    row, col, subgrid = window
+    return row, col, subgrid.histogram(x, y, weights, channel, n_channels)
+
+
+def strike_probability(landing, grid, fragments_per_year=1., x=0., y=0., channel=None, n_channels=1):
+    """
+    Strike probability per m2 and year from the landing samples of one turbine.
+
+    Every sample stands for fragments_per_year / len(landing) fragments (times
+    its importance weight), x and y is the turbine position in grid
+    coordinates. Returns (row, col, window) like strike_window.
+    """
+    weight = landing.weight * (fragments_per_year / (len(landing) * grid.cell_area))
+    return strike_window(grid, x + landing.x, y + landing.y, weight, channel, n_channels)
+
+
+def delete_raster(path):
+    """Remove the files of the raster at path (the .npy, its .json and the turbine windows)"""
+    stem = os.path.splitext(path)[0]
+    for file in (path, stem + '.json'):
+        if os.path.exists(file):
+            os.remove(file)
+    shutil.rmtree(stem + '.turbines', ignore_errors=True)
+
+
+class ProbabilityRaster:
+    """
+    Park strike raster backed by a memory mapped .npy file.
+
+    add_landing adds strike probability per m2 and year. Rasters holding
+    other values (e.g. the landed fragments per cell of REBooT_park) say so
+    in attrs['unit'].
+
+    With channels the raster is a (channels, ny, nx) stack, e.g. one layer per
+    ice type and impact energy class (see risk_analysis_individual_risk).
+
+    >>> import tempfile
+    >>> raster = ProbabilityRaster.create(tempfile.mkdtemp() + '/park.npy', Grid(0, 0, 4, 4, 1.))
+    >>> raster.add('T1', 1, 1, np.ones((2, 2)))
+    >>> raster.add('T1', 0, 0, np.ones((1, 1)))  # a rerun replaces the old window
+    >>> float(raster.data.sum())
+    1.0
+    """
+
+    def __init__(self, path, mode='r+'):
+        self.path = path
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        self.grid = Grid(**meta['grid'])
+        self.windows = meta['turbines']
+        self.attrs = meta.get('attrs', {})
+        self.data = np.load(path, mmap_mode=mode)
+
+    @classmethod
+    def create(cls, path, grid, dtype=np.float32, channels=None, **attrs):
+        """
+        New zero raster on disk, only the header is written up front.
+
+        Extra keyword arguments are json serializable attributes kept in the
+        metadata (available as raster.attrs).
+        """
+        shape = grid.shape if channels is None else (channels,) + grid.shape
+        np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape).flush()
+        with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+            json.dump(dict(grid=grid._asdict(), turbines={}, attrs=attrs), f)
+        return cls(path)
+
+    @property
+    def channels(self):
+        return self.data.shape[0] if self.data.ndim == 3 else None
+
+    @property
+    def _meta_path(self):
+        return os.path.splitext(self.path)[0] + '.json'
+
+    def _window_path(self, name):
+        return os.path.join(os.path.splitext(self.path)[0] + '.turbines', f'{name}.npy')
+
+    def _save_meta(self):
+        with open(self._meta_path, 'w') as f:
+            json.dump(dict(grid=self.grid._asdict(), turbines=self.windows, attrs=self.attrs), f)
+
+    def add(self, name, row, col, window):
+        """
+        Add the window of turbine name at offset row, col.
+
+        If the turbine was added before, its old contribution is subtracted
+        first, so results can be updated turbine by turbine.
+        """
+        if name in self.windows:
+            self.remove(name)
+        window = np.asarray(window, dtype=self.data.dtype)
+        h, w = window.shape[-2:]
+        self.data[..., row:row + h, col:col + w] += window
+        os.makedirs(os.path.dirname(self._window_path(name)), exist_ok=True)
+        np.save(self._window_path(name), window)
+        self.windows[name] = [row, col]
+        self._save_meta()
+
+    def window(self, name):
+        """(row, col, window) of a turbine added before"""
+        row, col = self.windows[name]
+        return row, col, np.load(self._window_path(name))
+
+    def remove(self, name):
+        row, col = self.windows.pop(name)
+        window = np.load(self._window_path(name))
+        h, w = window.shape[-2:]
+        self.data[..., row:row + h, col:col + w] -= window
+        os.remove(self._window_path(name))
+        self._save_meta()
+
+    def add_landing(self, name, landing, x, y, fragments_per_year, channel=None):
+        """Bin the landing samples of a turbine at x, y and add them to the park"""
+        result = strike_probability(landing, self.grid, fragments_per_year, x, y,
+                                    channel, self.channels or 1)
+        if result is not None:
+            self.add(name, *result)
+        elif name in self.windows:
+            # the rerun lands outside the grid, so nothing of the old run may stay
+            self.remove(name)
+
+    def tiles(self, tile_size=1024):
+        """Yield (rows, cols, tile) views of the raster without loading all of it"""
+        for rows, cols in self.grid.tiles(tile_size):
+            yield rows, cols, self.data[..., rows, cols]
+
+    def flush(self):
+        self.data.flush()
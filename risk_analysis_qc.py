@@ -55,23 +55,11 @@ The questions from the quality test is repeated in the survey below.
 
 
 """
+import datetime
+import os
 import streamlit as st
-import functools
-radio = functools.partial(st.radio, options=['yes','no','NA', 'not answered'], index=3)
 
-_questions = {}
-def callback(key):
-    if not key in _questions:
-        _questions[key] = st.sidebar.container()#sidebar.empty()
-    st.write(f'#### {key}')
-    st.write(AQT[key])
-    answer = radio('', key=key+'_answer')
-    if answer == 'yes':
-        _questions[key].success(key)
-    elif answer == 'no':
-        _questions[key].error(key)
-    elif answer == 'NA':
-        _questions[key].warning(f'{key}: '+st.text_input('Give reason', key=key+'_description'))
+OPTIONS = ['yes', 'no', 'NA', 'not answered']
 
 sections = ['Framing the Analysis and Its Interface With Decision Making', # A
             'Capturing the Risk Generating Process (RGP)', # B
@@ -254,7 +242,90 @@ AQT.update({'N1': 'Are key terms defined?',
 # Budget and Schedule Adequacy
 AQT['O1'] = 'Is the budget and schedule adequate to support the risk analysis at an appropriate level of quality and defensibility? Typically a case can be made for an improved analysis with a larger budget and longer schedule. In the real world there is always a trade-off between analysis quality (as defined by these AQTs), budget and schedule. But this AQT is targeted to sitations where a convincing case can be made that the analysis is too restricted by budget and/or schedule to do an adequate job of supporting the risk managment decisions at hand.'
 
-_answers = {}
+# Question keys per category, computed once instead of scanning AQT on every rerun
+AQT_INDEX = {}
+for _key in AQT:
+    AQT_INDEX.setdefault(_key[0], []).append(_key)
+SECTIONS = dict(zip(list('ABCDEFGHIJKLMNO'), sections))
+
+
+def survey_state():
+    """Submitted answers of this session: question key -> (answer, NA justification)"""
+    return st.session_state.setdefault('raqt', {})
+
+
+def ask_question(key, state):
+    st.write(f'#### {key}')
+    st.write(AQT[key])
+    answer, description = state.get(key, ('not answered', ''))
+    answer = st.radio(f'Answer to {key}', OPTIONS, index=OPTIONS.index(answer), key=key + '_answer',
+                      label_visibility='collapsed')
+    if answer == 'NA':
+        description = st.text_input('Give reason', description, key=key + '_description')
+    return answer, description
+
+
+def ask_questions(group):
+    """Form for one category, the answers are stored in the session on submit"""
+    state = survey_state()
+    with st.form(group):
+        st.write(f"### Category {group} \n{SECTIONS[group]}\n")
+        responses = {key: ask_question(key, state) for key in AQT_INDEX[group]}
+        if st.form_submit_button():
+            state.update(responses)
+
+
+def show_status(group):
+    """Answer counts per category, and the submitted state of each question in group"""
+    state = survey_state()
+    st.sidebar.write('#### Answered')
+    for g, keys in AQT_INDEX.items():
+        answers = [state[k][0] for k in keys if k in state and state[k][0] != 'not answered']
+        if answers:
+            st.sidebar.write(f"{g}: {len(answers)}/{len(keys)} "
+                             f"(yes {answers.count('yes')}, no {answers.count('no')}, NA {answers.count('NA')})")
+    for key in AQT_INDEX[group]:
+        answer, description = state.get(key, ('not answered', ''))
+        if answer == 'yes':
+            st.sidebar.success(key)
+        elif answer == 'no':
+            st.sidebar.error(key)
+        elif answer == 'NA':
+            st.sidebar.warning(f'{key}: {description}')
+
+
+def survey(include_questions=False):
+    """Submitted answers of this session in the same layout as the widget keys"""
+    result = {}
+    for key, (answer, description) in survey_state().items():
+        result[key + '_answer'] = answer
+        if answer == 'NA':
+            result[key + '_description'] = description
+    if include_questions:
+        result.update(AQT)
+        result.update(SECTIONS)
+    return result
+
+
+def store_survey():
+    from risk_analysis_qc_store import shared_store
+    try:
+        store = shared_store(os.environ.get('DATABASE_URL', ':memory:'))
+    except Exception as e:
+        st.error(f'Cannot open the survey database: {e}')
+        return
+    analysis_id = st.text_input('ID of the reviewed analysis')
+    reviewer = st.text_input('Reviewer')
+    if st.button('Store survey', disabled=not analysis_id):
+        store.save_survey(analysis_id, survey_state(), reviewer or None)
+        st.success(f'Stored survey of {analysis_id}')
+    year = st.number_input('Year', 2000, 2100, datetime.date.today().year)
+    # queried on request only, the expander body runs on every rerun even when collapsed
+    if st.button("Share of 'no' answers"):
+        st.write("Share of 'no' answers per category across stored analyses:",
+                 store.answer_shares('no', year))
+
+
 def main():
     with st.expander('Overview', expanded=True):
         st.write(__doc__)
@@ -270,11 +341,10 @@ def main():
         st.checkbox('Consider every discovered shortfall as an "Opportunity To Improve"')
         st.checkbox('Awareness on shortfalls, and the implications of those shortfalls for the decision making')
 
-        def ask_questions(group):
-            _answers[group] = {key: callback(key) for key in AQT.keys() if key.startswith(group)}
-
-    with st.expander('Take the survey'):
-        st.write('Select which groups to answer in the sidebar.')
+    group = st.sidebar.selectbox('Category', list(SECTIONS), format_func=lambda g: f'{g} {SECTIONS[g]}')
+    with st.expander('Take the survey', expanded=True):
+        st.write('Select which category to answer in the sidebar. Only that category is shown, '
+                 'answers to the other categories are kept.')
         st.write('Hit submit button after completing a group of questions to update the state. The submitted state of each answered question is shown in sidebar.')
         st.write('NA means not applicable, that means it should be accomanied by an justification if not obvious.')
         st.write("Note that for the NA choice a text widgets to elaborate will show after the submit button has been pressed")
@@ -282,23 +352,14 @@ def main():
         
         st.write('Hit the download checkbox at the bottom to extract your choices.')
         st.write('\n')
-        
-        for i,(key,value) in enumerate(zip(list('ABCDEFGHIJKLMNO'), sections)):
-            if st.sidebar.checkbox(f'{key} {sections[i]}', True):
-                with st.form(key):
-                    st.write(f"### Category {key} \n{value}\n")
-                    ask_questions(key)
-                    st.form_submit_button()
-            st.write('\n')
-    #with st.expander('The battery of questions'):
-    #    st.write(AQT)
+        ask_questions(group)
+    show_status(group)
+
+    with st.expander('Store survey'):
+        store_survey()
 
     if st.checkbox('Download survey'):
-        survey = {key:value for key,value in st.session_state.items() if not 'FormSubmitter' in key}
-        if st.checkbox('Include questions'):
-            survey.update(AQT)
-            survey.update(dict(zip(list('ABCDEFGHIJKLMNOP'), sections)))
-        st.write(repr(survey))
+        st.write(repr(survey(st.checkbox('Include questions'))))
         
         
 if __name__ == '__main__':
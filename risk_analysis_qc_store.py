@@ -0,0 +1,149 @@
+"""
+Persistence of Risk Analysis Quality Test (RAQT) surveys
+
+Answers, NA justifications and the id of the reviewed analysis are stored in
+the database selected by DATABASE_URL (SQLite: ':memory:', a file path or
+sqlite:///path). Connections come from a small pool shared by the Streamlit
+sessions of a process, a survey is written in one transaction with batched
+inserts, and cross-analysis questions are answered by indexed SQL queries,
+e.g. the share of 'no' answers per category for all analyses of 2025:
+
+    >>> store = SurveyStore(':memory:')
+    >>> store.save_survey('IceRisk park A', {'A1': ('no', ''), 'A2': ('yes', ''), 'B1': ('NA', 'no RGP')},
+    ...                   submitted='2025-03-01')
+    1
+    >>> store.answer_shares('no', year=2025)
+    {'A': 0.5, 'B': 0.0}
+"""
+__author__ = 'Rolv.Bredesen'
+
+import contextlib
+import datetime
+import functools
+import itertools
+import os
+import queue
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS raqt_survey (
+    id INTEGER PRIMARY KEY,
+    analysis_id TEXT NOT NULL,
+    reviewer TEXT,
+    submitted TEXT NOT NULL  -- ISO date
+);
+CREATE TABLE IF NOT EXISTS raqt_answer (
+    survey_id INTEGER NOT NULL REFERENCES raqt_survey(id) ON DELETE CASCADE,
+    question TEXT NOT NULL,
+    category TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    justification TEXT,
+    PRIMARY KEY (survey_id, question)
+);
+CREATE INDEX IF NOT EXISTS raqt_survey_submitted ON raqt_survey(submitted);
+CREATE INDEX IF NOT EXISTS raqt_survey_analysis ON raqt_survey(analysis_id);
+CREATE INDEX IF NOT EXISTS raqt_answer_category ON raqt_answer(category, answer);
+"""
+
+_memory_databases = itertools.count()
+
+
+def sqlite_path(database_url):
+    """Path or URI for sqlite3.connect, ':memory:' gets a shared in-memory database"""
+    if database_url in (None, '', ':memory', ':memory:'):
+        # shared cache, so all pooled connections see the same database
+        return f'file:raqt_{os.getpid()}_{next(_memory_databases)}?mode=memory&cache=shared'
+    if database_url.startswith('sqlite:///'):
+        return database_url[len('sqlite:///'):]
+    if '://' in database_url:
+        raise ValueError(f'Only SQLite databases are supported, got {database_url!r}')
+    return database_url
+
+
+class ConnectionPool:
+    def __init__(self, database_url, size=4):
+        path = sqlite_path(database_url)
+        self._pool = queue.Queue()
+        for _ in range(size):
+            connection = sqlite3.connect(path, uri=path.startswith('file:'), check_same_thread=False,
+                                         timeout=30)
+            connection.execute('PRAGMA foreign_keys = ON')
+            self._pool.put(connection)
+        with self.connection() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection, committed on success and rolled back on errors"""
+        connection = self._pool.get()
+        try:
+            with connection:
+                yield connection
+        finally:
+            self._pool.put(connection)
+
+
+class SurveyStore:
+    def __init__(self, database_url=':memory:', pool_size=4):
+        self.pool = ConnectionPool(database_url, pool_size)
+
+    def save_surveys(self, surveys):
+        """
+        Store many surveys in one transaction.
+
+        surveys is an iterable of (analysis_id, answers, reviewer, submitted)
+        where answers maps question keys (e.g. 'A1') to (answer, justification).
+        Unanswered questions are skipped. Returns the new survey ids.
+        """
+        ids = []
+        rows = []
+        with self.pool.connection() as connection:
+            for analysis_id, answers, reviewer, submitted in surveys:
+                submitted = submitted or datetime.date.today().isoformat()
+                cursor = connection.execute(
+                    'INSERT INTO raqt_survey (analysis_id, reviewer, submitted) VALUES (?, ?, ?)',
+                    (analysis_id, reviewer, str(submitted)))
+                ids.append(cursor.lastrowid)
+                # like survey(), a justification is only kept for NA answers
+                rows.extend((cursor.lastrowid, key, key[0], answer,
+                             (justification or None) if answer == 'NA' else None)
+                            for key, (answer, justification) in answers.items()
+                            if answer != 'not answered')
+            connection.executemany(
+                'INSERT INTO raqt_answer (survey_id, question, category, answer, justification) '
+                'VALUES (?, ?, ?, ?, ?)', rows)
+        return ids
+
+    def save_survey(self, analysis_id, answers, reviewer=None, submitted=None):
+        return self.save_surveys([(analysis_id, answers, reviewer, submitted)])[0]
+
+    def answer_shares(self, answer='no', year=None):
+        """Share of the given answer among the answered questions per category"""
+        where, params = '', [answer]
+        if year is not None:
+            where = 'WHERE s.submitted >= ? AND s.submitted < ?'
+            params += [f'{year}-01-01', f'{int(year) + 1}-01-01']
+        with self.pool.connection() as connection:
+            rows = connection.execute(
+                'SELECT a.category, AVG(a.answer = ?) FROM raqt_answer a '
+                f'JOIN raqt_survey s ON s.id = a.survey_id {where} '
+                'GROUP BY a.category ORDER BY a.category', params).fetchall()
+        return dict(rows)
+
+    def surveys(self, analysis_id):
+        """Answers of all surveys of an analysis: survey id -> {key: (answer, justification)}"""
+        with self.pool.connection() as connection:
+            rows = connection.execute(
+                'SELECT s.id, a.question, a.answer, a.justification FROM raqt_survey s '
+                'JOIN raqt_answer a ON s.id = a.survey_id WHERE s.analysis_id = ? '
+                'ORDER BY s.id', (analysis_id,)).fetchall()
+        result = {}
+        for survey_id, question, answer, justification in rows:
+            result.setdefault(survey_id, {})[question] = (answer, justification or '')
+        return result
+
+
+@functools.lru_cache(maxsize=None)
+def shared_store(database_url=':memory:'):
+    """One SurveyStore (and connection pool) per DATABASE_URL and process"""
+    return SurveyStore(database_url)
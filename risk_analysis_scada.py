@@ -0,0 +1,407 @@
+"""
+# Wind and icing statistics from SCADA and met forecast time series
+
+Step 2 of prevalent_approach_for_risk_assessments.md asks for wind statistics
+representative for periods when icing and melting may occur. This module keeps
+them up to date from years of 10 minute SCADA / forecast data without ever
+holding (or re-reading) the full time series:
+
+  - TimeSeriesStore: columnar store, one .npy file per column in parts
+    grouped by month (<store>/<YYYY-MM>/<part>/<column>.npy). New data is
+    appended as new parts, existing parts are never rewritten and are read
+    memory mapped in chunks.
+  - IcingDetector: classifies every sample as no ice, icing, iced or melting.
+    Its state (ice on the blades, warm hours since the last icing) is carried
+    from chunk to chunk, so episodes spanning parts and months are detected.
+  - IcingStatistics: hours per wind speed x direction x icing state and
+    month, plus the icing episodes. update() only processes the parts it has
+    not seen, so a new month of data costs one month of processing.
+
+    store = TimeSeriesStore('scada')
+    import_csv(store, 'scada_2025-01.csv')
+    stats = IcingStatistics('icing_stats', IcingDetector())
+    stats.update(store)
+    stats.write_icing_hours('icing.csv', fragments_per_hour=5.)  # icing_hours of a REBooT park
+"""
+__author__ = 'Rolv.Bredesen'
+
+import csv
+import itertools
+import json
+import os
+from typing import NamedTuple
+
+import numpy as np
+
+COLUMNS = ('wind_speed', 'wind_direction', 'temperature', 'humidity', 'power')
+STATES = ('none', 'icing', 'iced', 'melting')
+NONE, ICING, ICED, MELTING = range(len(STATES))
+SPEED_EDGES = tuple(float(v) for v in range(0, 26))  # m/s, the last bin is open ended
+
+
+def _month(time):
+    return np.datetime_as_string(time.astype('datetime64[M]'), unit='M')
+
+
+class TimeSeriesStore:
+    """
+    Append only columnar store of time series, partitioned by month.
+
+    Every part holds a 'time' column (datetime64[s]) and float32 data columns.
+    Rows are expected to be appended in time order.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def months(self):
+        return sorted(m for m in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, m)))
+
+    def parts(self, month=None):
+        """Parts as 'YYYY-MM/part', in time order"""
+        months = self.months() if month is None else [month]
+        return [f'{m}/{p}' for m in months for p in sorted(os.listdir(os.path.join(self.directory, m)))
+                if not p.startswith('.')]
+
+    def append(self, time, **columns):
+        """Write a chunk of rows as a new part of every month it covers, returns the new parts"""
+        time = np.asarray(time, dtype='datetime64[s]')
+        months = _month(time)
+        new = []
+        for month in dict.fromkeys(months):
+            rows = months == month
+            os.makedirs(os.path.join(self.directory, month), exist_ok=True)
+            part = f'{month}/{len(os.listdir(os.path.join(self.directory, month))):05d}'
+            # written under a temporary name, a half written part is never picked up
+            tmp = os.path.join(self.directory, month, f'.{os.path.basename(part)}')
+            os.makedirs(tmp)
+            np.save(os.path.join(tmp, 'time.npy'), time[rows])
+            for name, values in columns.items():
+                np.save(os.path.join(tmp, f'{name}.npy'), np.asarray(values, dtype=np.float32)[rows])
+            os.replace(tmp, os.path.join(self.directory, part))
+            new.append(part)
+        return new
+
+    def read(self, part, columns=None):
+        """Columns of a part as memory mapped arrays, missing columns are all NaN"""
+        path = os.path.join(self.directory, part)
+        data = {'time': np.load(os.path.join(path, 'time.npy'), mmap_mode='r')}
+        for name in columns or COLUMNS:
+            file = os.path.join(path, f'{name}.npy')
+            data[name] = (np.load(file, mmap_mode='r') if os.path.exists(file)
+                          else np.full(len(data['time']), np.nan, dtype=np.float32))
+        return data
+
+    def chunks(self, parts=None, columns=None, chunk_size=2**20):
+        """Yield (part, chunk) with chunk a dict of at most chunk_size rows of every column"""
+        for part in self.parts() if parts is None else parts:
+            data = self.read(part, columns)
+            for start in range(0, len(data['time']), chunk_size):
+                yield part, {k: np.asarray(v[start:start + chunk_size]) for k, v in data.items()}
+
+
+def _floats(values):
+    return np.array([v if v not in ('', 'NA', 'NaN') else 'nan' for v in values], dtype=np.float32)
+
+
+def import_csv(store, path, columns=None, time_column='time', chunk_size=10**6):
+    """
+    Stream a (multi-GB) csv file into the store, chunk_size rows at a time.
+
+    columns maps store column names to csv column names (default: the same
+    names for the COLUMNS found in the file). Times are ISO 8601. Returns the
+    number of rows imported.
+    """
+    rows = 0
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        if columns is None:
+            columns = {name: name for name in COLUMNS if name in header}
+        index = {name: header.index(source) for name, source in columns.items()}
+        it = header.index(time_column)
+        while True:
+            chunk = list(itertools.islice(reader, chunk_size))
+            if not chunk:
+                return rows
+            values = list(zip(*chunk))
+            store.append(np.array(values[it], dtype='datetime64[s]'),
+                         **{name: _floats(values[i]) for name, i in index.items()})
+            rows += len(chunk)
+
+
+def import_parquet(store, path, columns=None, time_column='time', chunk_size=10**6):
+    """Like import_csv for Parquet files, reading one record batch at a time (needs pyarrow)"""
+    import pyarrow.parquet as pq
+
+    source = pq.ParquetFile(path)
+    if columns is None:
+        columns = {name: name for name in COLUMNS if name in source.schema_arrow.names}
+    rows = 0
+    for batch in source.iter_batches(batch_size=chunk_size, columns=[time_column, *columns.values()]):
+        store.append(batch.column(time_column).to_numpy().astype('datetime64[s]'),
+                     **{name: batch.column(c).to_numpy(zero_copy_only=False) for name, c in columns.items()})
+        rows += batch.num_rows
+    return rows
+
+
+class IcingDetector:
+    """
+    Icing state of every sample of a time series, processed chunk by chunk.
+
+    Meteorological icing is temperature <= temperature_max and humidity >=
+    humidity_min. With a power_curve ((wind speeds), (power)) production
+    below (1 - power_deficit) of the curve at temperature <=
+    production_temperature also counts as icing. After icing the ice stays
+    (iced) until melt_hours of temperatures above melt_temperature have
+    passed (melting). interval is the length of a sample [s].
+
+    >>> detector = IcingDetector(interval=3600., melt_hours=2.)
+    >>> t = np.array([2., -1, -1, -3, 1, -2, 2, 3, 3])
+    >>> rh = np.array([80., 99, 99, 80, 80, 80, 80, 80, 80])
+    >>> detector.states(temperature=t, humidity=rh).tolist()
+    [0, 1, 1, 2, 3, 2, 3, 0, 0]
+    """
+
+    def __init__(self, temperature_max=0., humidity_min=95., melt_temperature=0., melt_hours=3.,
+                 power_curve=None, power_deficit=0.15, production_temperature=3., interval=600.):
+        self.temperature_max = temperature_max
+        self.humidity_min = humidity_min
+        self.melt_temperature = melt_temperature
+        self.melt_hours = melt_hours
+        self.power_curve = power_curve
+        self.power_deficit = power_deficit
+        self.production_temperature = production_temperature
+        self.interval = interval
+        self.warm_samples = np.inf  # warm samples since the last icing sample
+
+    def icing(self, temperature, humidity, wind_speed=None, power=None):
+        icing = (temperature <= self.temperature_max) & (humidity >= self.humidity_min)
+        if self.power_curve is not None and power is not None:
+            expected = np.interp(wind_speed, *self.power_curve, left=0., right=0.)
+            icing |= ((temperature <= self.production_temperature) & (expected > 0)
+                      & (power < (1 - self.power_deficit) * expected))
+        return icing
+
+    def states(self, temperature, humidity, wind_speed=None, power=None):
+        """State code (index in STATES) of every sample, continuing from the previous chunk"""
+        icing = self.icing(temperature, humidity, wind_speed, power)
+        warm = temperature > self.melt_temperature
+        cumulative = np.cumsum(warm)
+        # warm samples since the last icing sample, carried over from earlier chunks
+        last = np.maximum.accumulate(np.where(icing, np.arange(len(icing)), -1))
+        since = np.where(last >= 0, cumulative - cumulative[np.maximum(last, 0)],
+                         self.warm_samples + cumulative)
+        present = icing | (since - warm < self.melt_hours * 3600. / self.interval)
+        if len(since):
+            self.warm_samples = float(since[-1])
+        state = np.where(present, np.where(warm, MELTING, ICED), NONE).astype(np.uint8)
+        state[icing] = ICING
+        return state
+
+    def config(self):
+        return {k: v for k, v in vars(self).items() if k != 'warm_samples'}
+
+
+class Episode(NamedTuple):
+    start: str  # ISO time of the first sample with ice
+    end: str  # ISO time of the last sample with ice
+    icing_hours: float
+    iced_hours: float
+    melting_hours: float
+
+
+class IcingStatistics:
+    """
+    Joint wind speed x direction x icing state hours, updated incrementally.
+
+    hours(...) has shape (len(speed_edges), 360 / direction_bin, len(STATES)),
+    direction bins are centred on 0, direction_bin, ... degrees. Everything is
+    saved in directory after each part, so an interrupted update resumes where
+    it stopped.
+    """
+
+    def __init__(self, directory, detector=None, speed_edges=SPEED_EDGES, direction_bin=30.):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        meta = self._load_meta()
+        if meta is None:
+            self.detector = detector or IcingDetector()
+            self.speed_edges = np.array(speed_edges, dtype=float)
+            self.direction_bin = float(direction_bin)
+            self.parts, self.episodes, self.open_episode = [], [], None
+        else:
+            self.detector = IcingDetector(**meta['detector'])
+            self.detector.warm_samples = meta['warm_samples']
+            self.speed_edges = np.array(meta['speed_edges'])
+            self.direction_bin = meta['direction_bin']
+            self.parts = meta['parts']
+            self.episodes = [Episode(*e) for e in meta['episodes']]
+            self.open_episode = meta['open_episode']
+        self.shape = (len(self.speed_edges), int(round(360 / self.direction_bin)), len(STATES))
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.directory, 'icing_statistics.json')
+
+    def _month_path(self, month):
+        return os.path.join(self.directory, f'{month}.npy')
+
+    def _load_meta(self):
+        if not os.path.exists(self._meta_path):
+            return None
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        return meta
+
+    def _save_meta(self):
+        meta = dict(detector=self.detector.config(), warm_samples=self.detector.warm_samples,
+                    speed_edges=self.speed_edges.tolist(), direction_bin=self.direction_bin,
+                    parts=self.parts, episodes=self.episodes, open_episode=self.open_episode)
+        tmp = self._meta_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._meta_path)
+
+    def months(self):
+        return sorted(f[:-4] for f in os.listdir(self.directory) if f.endswith('.npy'))
+
+    def month_hours(self, month):
+        path = self._month_path(month)
+        return np.load(path) if os.path.exists(path) else np.zeros(self.shape)
+
+    def update(self, store, chunk_size=2**20):
+        """Add the parts of store not processed before, returns the number of new rows"""
+        done = set(self.parts)
+        new = [p for p in store.parts() if p not in done]
+        rows = 0
+        for part in new:
+            month = part.split('/')[0]
+            hours = self.month_hours(month)
+            for _, chunk in store.chunks([part], chunk_size=chunk_size):
+                hours += self._add_chunk(chunk)
+                rows += len(chunk['time'])
+            np.save(self._month_path(month), hours)
+            self.parts.append(part)
+            self._save_meta()
+        return rows
+
+    def _add_chunk(self, chunk):
+        dt = self.detector.interval / 3600.
+        state = self.detector.states(chunk['temperature'], chunk['humidity'],
+                                     chunk['wind_speed'], chunk['power'])
+        self._add_episodes(chunk['time'], state, dt)
+        speed, direction = chunk['wind_speed'], chunk['wind_direction']
+        valid = np.isfinite(speed) & np.isfinite(direction)
+        s = np.clip(np.searchsorted(self.speed_edges, speed[valid], side='right') - 1, 0, self.shape[0] - 1)
+        d = np.floor(np.mod(direction[valid] + self.direction_bin / 2, 360.) / self.direction_bin)
+        d = np.minimum(d.astype(np.intp), self.shape[1] - 1)
+        flat = (s * self.shape[1] + d) * self.shape[2] + state[valid]
+        return (dt * np.bincount(flat, minlength=np.prod(self.shape))).reshape(self.shape)
+
+    def _add_episodes(self, time, state, dt):
+        """Close the episodes (runs of samples with ice) ending in this chunk"""
+        present = state != NONE
+        if not len(state):
+            return
+        edges = np.diff(present.astype(np.int8), prepend=np.int8(self.open_episode is not None),
+                        append=np.int8(0))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        if self.open_episode is not None:
+            starts = np.concatenate([[0], starts])
+        counts = np.stack([np.cumsum(state == s) for s in (ICING, ICED, MELTING)], axis=1) * dt
+        counts = np.concatenate([np.zeros((1, 3)), counts])
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            hours = counts[end] - counts[start]
+            first, last = str(time[start]), str(time[end - 1]) if end > start else None
+            if i == 0 and self.open_episode is not None:
+                first, previous, *carried = self.open_episode
+                hours = hours + carried
+                last = last or previous
+                self.open_episode = None
+            if end == len(state):
+                # still going at the end of the chunk
+                self.open_episode = [first, last, *hours.tolist()]
+            else:
+                self.episodes.append(Episode(first, last, *hours.tolist()))
+
+    def hours(self, months=None, states=None):
+        """
+        Hours per wind speed x direction bin, summed over months (default all).
+
+        With states (names from STATES) the states are summed too, otherwise
+        the last axis is the state.
+        """
+        total = np.zeros(self.shape)
+        for month in self.months() if months is None else months:
+            total += self.month_hours(month)
+        if states is not None:
+            total = total[..., [STATES.index(s) for s in states]].sum(axis=-1)
+        return total
+
+    def wind_distribution(self, states=('icing', 'melting'), months=None):
+        """Joint probability of wind speed x direction bins during the given icing states"""
+        hours = self.hours(months, states)
+        return hours / hours.sum() if hours.sum() else hours
+
+    def bin_centres(self):
+        edges = self.speed_edges
+        speed = np.append((edges[:-1] + edges[1:]) / 2, edges[-1] + 1.)
+        return speed, np.arange(self.shape[1]) * self.direction_bin
+
+    def icing_hours(self, fragments_per_hour, states=('icing', 'iced', 'melting'), months=None):
+        """
+        Icing hours in the format of REBooT_park (wind_speed, wind_direction, fragments).
+
+        One row per wind bin with ice, fragments is the hours with ice in the
+        bin times fragments_per_hour.
+        """
+        hours = self.hours(months, states)
+        s, d = np.nonzero(hours)
+        speed, direction = self.bin_centres()
+        return dict(wind_speed=speed[s], wind_direction=direction[d],
+                    fragments=hours[s, d] * fragments_per_hour)
+
+    def write_icing_hours(self, path, fragments_per_hour, states=('icing', 'iced', 'melting'), months=None):
+        rows = self.icing_hours(fragments_per_hour, states, months)
+        np.savetxt(path, np.column_stack(list(rows.values())), delimiter=',',
+                   header=','.join(rows), comments='')
+
+
+def test_monthly_updates_match_one_pass():
+    import tempfile
+    rng = np.random.default_rng(1)
+    time = np.arange('2025-01-20T00:00', '2025-03-10T00:00', np.timedelta64(10, 'm'), dtype='datetime64[s]')
+    n = len(time)
+    data = dict(wind_speed=rng.weibull(2, n) * 8, wind_direction=rng.uniform(0, 360, n),
+                temperature=3 * np.sin(np.arange(n) / 300) + rng.normal(0, 1, n),
+                humidity=rng.uniform(90, 100, n), power=rng.uniform(0, 3000, n))
+    # an episode across the end of January
+    boundary = np.flatnonzero(time == np.datetime64('2025-02-01T00:00'))[0]
+    data['temperature'][boundary - 20:boundary + 20] = -5.
+    data['humidity'][boundary - 20:boundary + 20] = 99.
+
+    root = tempfile.mkdtemp()
+    one_pass = TimeSeriesStore(os.path.join(root, 'one_pass'))
+    one_pass.append(time, **data)
+    whole = IcingStatistics(os.path.join(root, 'whole_stats'))
+    whole.update(one_pass)
+
+    monthly = TimeSeriesStore(os.path.join(root, 'monthly'))
+    stats = IcingStatistics(os.path.join(root, 'monthly_stats'))
+    for month in np.unique(_month(time)):
+        rows = _month(time) == month
+        monthly.append(time[rows], **{k: v[rows] for k, v in data.items()})
+        # small chunks, so episodes also span chunks within a month
+        IcingStatistics(stats.directory).update(monthly, chunk_size=1000)
+    stats = IcingStatistics(stats.directory)
+
+    assert whole.months() == stats.months() == ['2025-01', '2025-02', '2025-03']
+    for month in whole.months():
+        assert np.allclose(whole.month_hours(month), stats.month_hours(month))
+    assert len(whole.episodes) == len(stats.episodes) > 1
+    # equal up to the rounding of hours summed over other chunks
+    for a, b in zip(whole.episodes + [whole.open_episode], stats.episodes + [stats.open_episode]):
+        assert tuple(a[:2]) == tuple(b[:2]) and np.allclose(a[2:], b[2:])
+    assert any(e.start < '2025-02' < e.end for e in whole.episodes)
@@ -0,0 +1,147 @@
+"""
+# Topography for the trajectory model
+
+Digital elevation models (DEM) are stored as a directory of square .npy
+tiles that are memory mapped on demand, with a least recently used cache of
+open tiles. Only the tiles fragments actually land in are touched, so a
+country scale DEM of many GB works on an ordinary node.
+
+Heights are sampled at the grid points x0 + j * resolution, y0 + i * resolution
+(row i northwards). Neighbouring tiles share their edge row and column, so
+bilinear interpolation of any point needs a single tile.
+
+    dem = write_dem_tiles('dem_tiles', heights, x0, y0, resolution=10.)
+    landing = simulate_landing(10**6, turbine, terrain=DEM('dem_tiles'), position=(x, y))
+"""
+__author__ = 'Rolv.Bredesen'
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+def write_dem_tiles(directory, heights, x0, y0, resolution, tile_size=1024, nodata=np.nan):
+    """
+    Split a (possibly memory mapped) height array into tiles on disk.
+
+    heights[i, j] is the height at x0 + j * resolution, y0 + i * resolution.
+    Cells equal to nodata are stored as NaN. Returns the DEM of the tiles.
+    """
+    os.makedirs(directory, exist_ok=True)
+    ny, nx = heights.shape
+    rows, cols = -(-(ny - 1) // tile_size), -(-(nx - 1) // tile_size)
+    tile_max = np.full((rows, cols), -np.inf)
+    for r in range(rows):
+        for c in range(cols):
+            tile = np.array(heights[r * tile_size:(r + 1) * tile_size + 1,
+                                    c * tile_size:(c + 1) * tile_size + 1], dtype=np.float32)
+            if not np.isnan(nodata):
+                tile[tile == nodata] = np.nan
+            np.save(os.path.join(directory, f'{r}_{c}.npy'), tile)
+            if np.isfinite(tile).any():
+                tile_max[r, c] = np.nanmax(tile)
+    meta = dict(x0=float(x0), y0=float(y0), resolution=float(resolution), tile_size=tile_size,
+                nx=nx, ny=ny, tile_max=tile_max.tolist())
+    with open(os.path.join(directory, 'dem.json'), 'w') as f:
+        json.dump(meta, f)
+    return DEM(directory)
+
+
+class DEM:
+    """
+    Tiled, memory mapped digital elevation model.
+
+    >>> import tempfile
+    >>> y, x = np.mgrid[0:5, 0:5]
+    >>> dem = write_dem_tiles(tempfile.mkdtemp(), x + 10. * y, 0, 0, 1., tile_size=2)
+    >>> dem.height(np.array([0.5, 3.25]), np.array([1., 2.5])).tolist()
+    [10.5, 28.25]
+    """
+
+    def __init__(self, directory, cache_tiles=64):
+        self.directory = directory
+        with open(os.path.join(directory, 'dem.json')) as f:
+            meta = json.load(f)
+        self.x0, self.y0 = meta['x0'], meta['y0']
+        self.resolution = meta['resolution']
+        self.tile_size = meta['tile_size']
+        self.nx, self.ny = meta['nx'], meta['ny']
+        self.tile_max = np.array(meta['tile_max'])
+        self.cache_tiles = cache_tiles
+        self._tiles = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __getstate__(self):
+        # open tiles are not sent to worker processes
+        state = self.__dict__.copy()
+        state['_tiles'] = OrderedDict()
+        return state
+
+    def fingerprint(self):
+        """Hash of dem.json and the size and modification time of every tile, changes when tiles are replaced"""
+        digest = hashlib.sha256()
+        with open(os.path.join(self.directory, 'dem.json'), 'rb') as f:
+            digest.update(f.read())
+        for entry in sorted(os.scandir(self.directory), key=lambda e: e.name):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                digest.update(f'{entry.name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+        return digest.hexdigest()
+
+    def tile(self, row, col):
+        """Memory mapped tile, kept open in the LRU cache"""
+        key = (row, col)
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return self._tiles[key]
+        self.misses += 1
+        tile = np.load(os.path.join(self.directory, f'{row}_{col}.npy'), mmap_mode='r')
+        self._tiles[key] = tile
+        if len(self._tiles) > self.cache_tiles:
+            self._tiles.popitem(last=False)
+        return tile
+
+    def height(self, x, y, fill=np.nan):
+        """Bilinear interpolation of the terrain height at x, y, fill outside the DEM and in gaps"""
+        x, y = np.broadcast_arrays(np.asarray(x, float), np.asarray(y, float))
+        fx = (x - self.x0) / self.resolution
+        fy = (y - self.y0) / self.resolution
+        inside = (fx >= 0) & (fx <= self.nx - 1) & (fy >= 0) & (fy <= self.ny - 1)
+        out = np.full(x.shape, fill, dtype=float)
+        if not inside.any():
+            return out
+        fx, fy = fx[inside], fy[inside]
+        i = np.minimum(fy.astype(np.intp), self.ny - 2)
+        j = np.minimum(fx.astype(np.intp), self.nx - 2)
+        wy, wx = fy - i, fx - j
+        tr, tc = i // self.tile_size, j // self.tile_size
+        li, lj = i - tr * self.tile_size, j - tc * self.tile_size
+        key = tr * self.tile_max.shape[1] + tc
+        order = np.argsort(key, kind='stable')
+        bounds = np.flatnonzero(np.diff(key[order])) + 1
+        values = np.empty(len(key))
+        # one pass per tile touched
+        for group in np.split(order, bounds):
+            tile = self.tile(int(tr[group[0]]), int(tc[group[0]]))
+            a, b = li[group], lj[group]
+            h00, h01 = tile[a, b], tile[a, b + 1]
+            h10, h11 = tile[a + 1, b], tile[a + 1, b + 1]
+            u, v = wx[group], wy[group]
+            values[group] = (h00 * (1 - u) + h01 * u) * (1 - v) + (h10 * (1 - u) + h11 * u) * v
+        out[inside] = np.where(np.isnan(values), fill, values)
+        return out
+
+    def max_height(self, xmin, xmax, ymin, ymax):
+        """Upper bound of the terrain height in a box, from the tile maxima (no tile reads)"""
+        span = self.tile_size * self.resolution
+        r0 = max(int((ymin - self.y0) // span), 0)
+        r1 = min(int((ymax - self.y0) // span), self.tile_max.shape[0] - 1)
+        c0 = max(int((xmin - self.x0) // span), 0)
+        c1 = min(int((xmax - self.x0) // span), self.tile_max.shape[1] - 1)
+        if r0 > r1 or c0 > c1:
+            return -np.inf
+        return float(self.tile_max[r0:r1 + 1, c0:c1 + 1].max())
@@ -0,0 +1,619 @@
+#!/usr/bin/env python
+"""
+# Ice throw trajectory model (IEA Wind Task 19)
+
+Vectorized Monte Carlo engine for the *mathematical trajectory/calculation model*
+listed in prevalent_approach_for_risk_assessments.md:
+
+  - Turbine parameters: hub height, rotor diameter, operational mode
+  - Physical parameters: air density, vertical wind profile,
+    radial distribution of ice on blades, no. of relevant fragments
+
+All fragments of a chunk are integrated together as NumPy arrays, there are
+no per-fragment Python loops. Landed fragments are compacted away in bulk so
+the cost follows the number of fragments still in the air. A single core
+handles about 10**6 fragments per second (see throughput()).
+
+Coordinates of the returned landing points are metres east (x) and north (y)
+of the turbine tower. Wind direction is meteorological (direction the wind
+blows *from*, degrees clockwise from north).
+
+Thresholds of 1e-5 to 1e-7 per year sit far out in the tail of the landing
+distribution. sample_release can oversample tip release, large fragments and
+high winds (tip_bias, mass_bias, wind_bias), every landing sample carries
+the importance weight, and exceedance_probability / ring_strike_probability
+give tail estimates with confidence intervals.
+
+# Uncertainty propagation
+
+The Spread of NUSAP elements (strength_of_knowledge_judgment/NUSAP_pedigree.py)
+is sampled with Latin hypercube or quasi-Monte Carlo designs, the model is
+evaluated in large vectorized batches and Sobol indices give the
+"sensitivity on critical assumptions" asked for by the guideline.
+"""
+__author__ = 'Rolv.Bredesen'
+
+import math
+from dataclasses import dataclass
+from typing import NamedTuple
+
+import numpy as np
+
+GRAVITY = 9.81
+ICE_DENSITY = {'rime': 450., 'glaze': 900.}  # kg/m3
+OPERATIONAL_MODES = ('operating', 'idling', 'standstill')
+
+
+@dataclass(frozen=True)
+class Turbine:
+    hub_height: float = 100.  # m
+    rotor_diameter: float = 120.  # m
+    rated_rpm: float = 14.  # max rotor speed
+    idle_rpm: float = 1.  # rotor speed when idling
+    tip_speed_ratio: float = 7.
+    root_fraction: float = 0.1  # no ice inside this fraction of the blade radius
+
+    @property
+    def radius(self):
+        return self.rotor_diameter / 2
+
+    @property
+    def h_plus_d(self):
+        """Hub height + rotor diameter, the usual reference safety distance"""
+        return self.hub_height + self.rotor_diameter
+
+    def rotor_speed(self, wind_speed, mode='operating'):
+        """Angular velocity [rad/s] of the rotor for the given hub wind speed"""
+        wind_speed = np.asarray(wind_speed, dtype=float)
+        if mode == 'operating':
+            omega_max = self.rated_rpm * 2 * np.pi / 60
+            return np.minimum(self.tip_speed_ratio * wind_speed / self.radius, omega_max)
+        if mode == 'idling':
+            return np.full_like(wind_speed, self.idle_rpm * 2 * np.pi / 60)
+        if mode == 'standstill':
+            return np.zeros_like(wind_speed)
+        raise ValueError(f'Unknown operational mode {mode!r}, use one of {OPERATIONAL_MODES}')
+
+
+class LandingSamples(NamedTuple):
+    x: np.ndarray  # m east of tower
+    y: np.ndarray  # m north of tower
+    mass: np.ndarray  # kg
+    impact_speed: np.ndarray  # m/s
+    weight: np.ndarray  # importance sampling weight, 1 for plain Monte Carlo
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def distance(self):
+        return np.hypot(self.x, self.y)
+
+    @property
+    def impact_energy(self):
+        """Kinetic energy [J] at impact"""
+        return 0.5 * self.mass * self.impact_speed**2
+
+    @classmethod
+    def concatenate(cls, samples):
+        samples = list(samples)
+        return cls(*(np.concatenate([getattr(s, f) for s in samples]) for f in cls._fields))
+
+
+def _wind(wind_speed, wind_direction, n, rng, wind_bias=0., per_fragment=False):
+    """
+    Hub wind speed and direction for n fragments, with importance weights.
+
+    Scalars are repeated. Arrays are wind samples that are resampled (speed
+    and direction jointly), with per_fragment=True they must have length n
+    and are used as they are. With wind_bias > 0 high wind samples are drawn
+    more often, with probability proportional to exp(wind_bias * speed /
+    max speed).
+    """
+    speed, direction = np.broadcast_arrays(np.asarray(wind_speed, float), np.asarray(wind_direction, float))
+    if speed.ndim == 0:
+        return np.full(n, float(speed)), np.full(n, float(direction)), np.ones(n)
+    if per_fragment:
+        if len(speed) != n:
+            raise ValueError(f'per fragment wind needs {n} values, got {len(speed)}')
+        if wind_bias:
+            raise ValueError('wind_bias needs wind samples to resample, not per fragment wind')
+        return speed, direction, np.ones(n)
+    if wind_bias:
+        q = np.exp(wind_bias * speed / speed.max())
+        q /= q.sum()
+        i = rng.choice(len(speed), n, p=q)
+        return speed[i], direction[i], 1 / (len(speed) * q[i])
+    i = rng.integers(0, len(speed), n)
+    return speed[i], direction[i], np.ones(n)
+
+
+def _power_law_pdf(r, exponent, r0, r1):
+    k = exponent + 1
+    return k * r**exponent / (r1**k - r0**k)
+
+
+def sample_release(n, turbine, wind_speed, wind_direction=0., mode='operating',
+                   mass_range=(0.05, 2.), ice_type='glaze', drag_coefficient=(0.6, 1.2),
+                   radial_exponent=1., tip_bias=0., mass_bias=0., wind_bias=0., per_fragment=False,
+                   rng=None):
+    """
+    Draw n fragments at the moment of release.
+
+    radial_exponent controls the radial distribution of ice on the blades, the
+    pdf of the release radius is proportional to r**radial_exponent (1: linearly
+    increasing ice load towards the tip, 0: uniform). Masses are log-uniform in
+    mass_range and drag coefficients uniform in drag_coefficient.
+
+    Importance sampling for the far tail: tip_bias raises the radial exponent
+    of the sampling distribution, mass_bias tilts the log-mass towards large
+    fragments (pdf ~ exp(mass_bias * t), t the position in log mass_range) and
+    wind_bias favours high wind samples (see _wind, per_fragment=True takes
+    wind arrays as one value per fragment). The returned weight is the
+    ratio of the true to the sampling density, so weighted estimates stay
+    unbiased. Returns position, velocity (rotor frame), drag parameter, mass
+    and weight arrays.
+    """
+    rng = np.random.default_rng(rng)
+    wind_speed, wind_direction, weight = _wind(wind_speed, wind_direction, n, rng, wind_bias, per_fragment)
+
+    r0, r1 = turbine.root_fraction * turbine.radius, turbine.radius
+    k = radial_exponent + tip_bias + 1
+    radius = (r0**k + rng.random(n) * (r1**k - r0**k))**(1 / k)
+    if tip_bias:
+        weight *= (_power_law_pdf(radius, radial_exponent, r0, r1)
+                   / _power_law_pdf(radius, radial_exponent + tip_bias, r0, r1))
+    azimuth = rng.uniform(0, 2 * np.pi, n)
+    omega = turbine.rotor_speed(wind_speed, mode)
+
+    t = rng.random(n)
+    if mass_bias:
+        # inverse cdf of the tilted density on [0, 1] and the likelihood ratio
+        t = np.log1p(t * np.expm1(mass_bias)) / mass_bias
+        weight *= np.expm1(mass_bias) / (mass_bias * np.exp(mass_bias * t))
+    log_m0, log_m1 = np.log(mass_range[0]), np.log(mass_range[1])
+    mass = np.exp(log_m0 + t * (log_m1 - log_m0))
+    cd = rng.uniform(*drag_coefficient, n)
+    # Plate-like fragment: frontal area ~ volume**(2/3)
+    area = (mass / ICE_DENSITY[ice_type])**(2 / 3)
+    drag = cd * area / mass  # multiplied by 0.5 * air density during integration
+
+    cos_a, sin_a = np.cos(azimuth), np.sin(azimuth)
+    return dict(
+        downwind=np.zeros(n), crosswind=radius * cos_a, height=turbine.hub_height + radius * sin_a,
+        v_downwind=np.zeros(n), v_crosswind=-omega * radius * sin_a, v_height=omega * radius * cos_a,
+        wind_speed=wind_speed, wind_direction=wind_direction, drag=drag, mass=mass, weight=weight)
+
+
+def integrate_trajectories(release, hub_height, air_density=1.3, shear_exponent=0.2,
+                           dt=0.25, max_time=60., dtype=np.float32, ground=None, ground_max=0.):
+    """
+    Integrate a batch of fragments until they reach the ground.
+
+    Quadratic drag relative to a power law wind profile
+    u(z) = u_hub * (z / hub_height)**shear_exponent, integrated with the
+    explicit midpoint method (second order, so dt=0.25 s stays within about a
+    metre of a dt=0.002 s reference). The wind is evaluated once per step. The
+    last step is extrapolated linearly to the ground. Returns downwind and
+    crosswind landing positions [m] and impact speed [m/s] as float64 arrays.
+
+    The ground is flat at z=0 unless ground(downwind, crosswind, index) gives
+    the terrain height relative to the tower base for the fragments index.
+    It is only called for fragments below ground_max, the highest terrain
+    within reach.
+    """
+    n = len(release['mass'])
+    px, py, pz = (release[k].astype(dtype) for k in ('downwind', 'crosswind', 'height'))
+    vx, vy, vz = (release[k].astype(dtype) for k in ('v_downwind', 'v_crosswind', 'v_height'))
+    kd = (0.5 * air_density * dt * release['drag']).astype(dtype)
+    u_hub = release['wind_speed'].astype(dtype)
+    alpha, inv_h = dtype(shear_exponent), dtype(1 / hub_height)
+    dt, half, gdt = dtype(dt), dtype(0.5), dtype(GRAVITY * dt)
+
+    land_x, land_y, land_v = np.empty(n), np.empty(n), np.empty(n)
+    idx = np.arange(n)
+    airborne = np.ones(n, dtype=bool)
+    grounded = 0
+    for _ in range(int(np.ceil(max_time / dt))):
+        u = pz * inv_h
+        np.maximum(u, 0.01, out=u)
+        np.power(u, alpha, out=u)
+        u *= u_hub
+        # half step velocity
+        rx = vx - u
+        f = np.sqrt(rx * rx + vy * vy + vz * vz)
+        f *= kd
+        f *= half
+        mx, my, mz = vx - f * rx, vy - f * vy, vz - f * vz
+        mz -= half * gdt
+        # full step with drag at the midpoint velocity
+        rx = mx - u
+        f = np.sqrt(rx * rx + my * my + mz * mz)
+        f *= kd
+        px += mx * dt
+        py += my * dt
+        pz += mz * dt
+        rx *= f
+        vx -= rx
+        vy -= f * my
+        vz -= f * mz
+        vz -= gdt
+
+        landed = pz <= ground_max
+        landed &= airborne
+        if landed.any():
+            j = np.flatnonzero(landed)
+            if ground is None:
+                g = 0.
+            else:
+                g = ground(px[j], py[j], idx[j])
+                hit = pz[j] <= g
+                j, g = j[hit], g[hit]
+            back = (pz[j] - g) / vz[j]
+            i = idx[j]
+            land_x[i] = px[j] - vx[j] * back
+            land_y[i] = py[j] - vy[j] * back
+            land_v[i] = np.sqrt(vx[j]**2 + vy[j]**2 + vz[j]**2)
+            airborne[j] = False
+            grounded += len(j)
+            # compacting is costly, only drop landed fragments in bulk
+            if 4 * grounded >= len(idx):
+                keep = airborne
+                idx = idx[keep]
+                if not len(idx):
+                    break
+                px, py, pz, vx, vy, vz, kd, u_hub, airborne = (
+                    a[keep] for a in (px, py, pz, vx, vy, vz, kd, u_hub, airborne))
+                grounded = 0
+    else:
+        raise RuntimeError(f'{airborne.sum()} fragments still airborne after {max_time} s')
+    return land_x, land_y, land_v
+
+
+def _to_map(downwind, crosswind, wind_direction):
+    """Rotate rotor-frame landing positions to east/north given wind-from direction"""
+    theta = np.radians(wind_direction)
+    # unit vector the wind blows towards, and the horizontal rotor axis
+    de, dn = -np.sin(theta), -np.cos(theta)
+    return downwind * de + crosswind * dn, downwind * dn - crosswind * de
+
+
+def simulate_landing(n, turbine=Turbine(), wind_speed=10., wind_direction=0., mode='operating',
+                     air_density=1.3, shear_exponent=0.2, chunk_size=2**15, seed=None,
+                     dt=0.25, terrain=None, position=(0., 0.), per_fragment=False, **fragment_kwargs):
+    """
+    Monte Carlo landing points for n ice fragments thrown from one turbine.
+
+    wind_speed and wind_direction are hub height values, either scalars or
+    arrays of samples from the wind statistics during icing (resampled
+    jointly, once for all n fragments). With per_fragment=True the arrays
+    hold one value per fragment and are kept in order, wind_bias can then
+    not be used.
+    Work is done in chunks of chunk_size fragments to keep arrays in cache.
+    terrain is an optional risk_analysis_terrain.DEM, fragments then land on
+    the terrain around the tower at position (DEM coordinates) instead of on
+    flat ground. Extra keyword arguments are passed on to sample_release.
+
+    >>> s = simulate_landing(10_000, seed=1)
+    >>> bool((s.distance < 500).all())
+    True
+    """
+    rng = np.random.default_rng(seed)
+    # drawn up front for all n fragments, the chunks take their slice of it
+    wind_speed, wind_direction, wind_weight = _wind(wind_speed, wind_direction, n, rng,
+                                                    fragment_kwargs.pop('wind_bias', 0.), per_fragment)
+    if terrain is not None:
+        x0, y0 = position
+        base = float(terrain.height(x0, y0))
+        if np.isnan(base):
+            raise ValueError(f'Turbine position {position} is outside the terrain model')
+        reach = 4 * turbine.h_plus_d
+        # outside the DEM and in gaps the ground is level with the tower base
+        ground_max = max(terrain.max_height(x0 - reach, x0 + reach, y0 - reach, y0 + reach) - base, 0.)
+    chunks = []
+    for start in range(0, n, chunk_size):
+        chunk = slice(start, min(start + chunk_size, n))
+        release = sample_release(chunk.stop - start, turbine, wind_speed[chunk], wind_direction[chunk],
+                                 mode=mode, per_fragment=True, rng=rng, **fragment_kwargs)
+        release['weight'] *= wind_weight[chunk]
+        ground = None
+        if terrain is not None:
+            def ground(downwind, crosswind, i, direction=release['wind_direction']):
+                x, y = _to_map(downwind, crosswind, direction[i])
+                return terrain.height(x0 + x, y0 + y, fill=base) - base
+        downwind, crosswind, impact = integrate_trajectories(
+            release, turbine.hub_height, air_density, shear_exponent, dt=dt,
+            ground=ground, ground_max=0. if terrain is None else ground_max)
+        x, y = _to_map(downwind, crosswind, release['wind_direction'])
+        chunks.append(LandingSamples(x, y, release['mass'], impact, release['weight']))
+    if not chunks:
+        return LandingSamples(*(np.empty(0) for _ in LandingSamples._fields))
+    return LandingSamples.concatenate(chunks)
+
+
+def throughput(n=10**6, **kwargs):
+    """Fragments per second for a simulate_landing run of n fragments"""
+    import time
+    t0 = time.perf_counter()
+    simulate_landing(n, **kwargs)
+    return n / (time.perf_counter() - t0)
+
+
+# Rare event estimates
+
+class TailEstimate(NamedTuple):
+    value: float
+    low: float  # confidence interval
+    high: float
+    relative_error: float  # standard error / value
+    effective_samples: float  # Kish effective sample size of the contributing samples
+
+
+def weighted_estimate(values, weights, z=1.96):
+    """
+    Importance sampling estimate of E[values] (values >= 0) with a confidence interval.
+
+    The interval is normal, clipped at 0. Without any hit the normal interval
+    would be [0, 0], so the upper bound is the rule of three instead: no hit in
+    n samples of weight up to max(weights) bounds the value by
+    -ln(1 - confidence) * max(weights) / n (3 * max(weights) / n at z=1.96).
+    """
+    terms = np.asarray(values, float) * weights
+    n = len(terms)
+    value = terms.mean() if n else 0.
+    hit = terms != 0
+    if not hit.any():
+        confidence = math.erf(z / math.sqrt(2))
+        high = -math.log(1 - confidence) * float(np.max(weights)) / n if n else np.inf
+        return TailEstimate(0., 0., high, np.inf, 0.)
+    se = terms.std(ddof=1) / np.sqrt(n) if n > 1 else np.inf
+    ess = terms[hit].sum()**2 / (terms[hit]**2).sum()
+    return TailEstimate(float(value), float(max(value - z * se, 0.)), float(value + z * se),
+                        float(se / value) if value else np.inf, float(ess))
+
+
+def exceedance_probability(landing, distance, z=1.96):
+    """Probability that a fragment lands further than distance [m] from the tower"""
+    return weighted_estimate(landing.distance > distance, landing.weight, z)
+
+
+def ring_strike_probability(landing, distance, width=10., z=1.96):
+    """
+    Strike probability per m2 for one fragment in the ring distance +- width/2.
+
+    Averaged over wind directions, e.g. at the H+D distance of a turbine
+    (hub height + rotor diameter).
+    """
+    r = landing.distance
+    inside = (r >= distance - width / 2) & (r < distance + width / 2)
+    area = np.pi * ((distance + width / 2)**2 - max(distance - width / 2, 0)**2)
+    estimate = weighted_estimate(inside, landing.weight, z)
+    return estimate._replace(value=estimate.value / area, low=estimate.low / area, high=estimate.high / area)
+
+
+# Uncertainty propagation from NUSAP spreads
+
+def latin_hypercube(n, d, rng=None):
+    """n points in [0, 1)**d with exactly one point in each of n strata per dimension"""
+    rng = np.random.default_rng(rng)
+    strata = rng.permuted(np.tile(np.arange(n), (d, 1)), axis=1).T
+    return (strata + rng.random((n, d))) / n
+
+
+_PRIMES = np.array([2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71,
+                    73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131, 137, 139, 149, 151])
+
+
+def halton(n, d, start=0, rng=None):
+    """
+    Quasi-Monte Carlo points from the Halton sequence, points start..start+n.
+
+    With rng, the points get a random shift modulo 1 (Cranley-Patterson
+    rotation), so repeated designs give independent error estimates.
+    """
+    if d > len(_PRIMES):
+        raise ValueError(f'Halton sequence implemented for up to {len(_PRIMES)} dimensions')
+    index = np.arange(start + 1, start + n + 1)
+    points = np.zeros((n, d))
+    for j, base in enumerate(_PRIMES[:d]):
+        i, scale = index.copy(), 1. / base
+        while i.any():
+            points[:, j] += (i % base) * scale
+            i //= base
+            scale /= base
+    if rng is not None:
+        points = (points + np.random.default_rng(rng).random(d)) % 1
+    return points
+
+
+def spread_inputs(store, indices):
+    """Numeral and spread [low, high] of NUSAP elements of a NUSAPStore"""
+    indices = np.asarray(indices)
+    return dict(names=[store.names[i] for i in indices], numeral=store.numeral[indices],
+                low=store.spread[indices, 0], high=store.spread[indices, 1])
+
+
+def scale_to_spread(u, low, high, numeral=None):
+    """
+    Map unit samples u (n, d) to the spreads.
+
+    Uniform on [low, high], or triangular with the mode at numeral when given
+    (the numeral is the best estimate of a NUSAP element).
+    """
+    low, high = np.asarray(low, float), np.asarray(high, float)
+    if numeral is None:
+        return low + u * (high - low)
+    width = high - low
+    c = np.divide(np.asarray(numeral, float) - low, width, out=np.full_like(width, 0.5), where=width > 0)
+    # inverse cdf of the triangular distribution
+    left = low + np.sqrt(u * width * (numeral - low))
+    right = high - np.sqrt((1 - u) * width * (high - numeral))
+    return np.where(u < c, left, right)
+
+
+class SobolResult(NamedTuple):
+    first_order: np.ndarray
+    total: np.ndarray
+    first_order_se: np.ndarray  # standard errors
+    total_se: np.ndarray
+    evaluations: int
+    converged: bool
+
+
+def sobol_indices(model, low, high, numeral=None, batch_size=4096, max_samples=2**20, tol=0.01,
+                  design='lhs', seed=None):
+    """
+    Variance based sensitivity indices of model over the input spreads.
+
+    model maps an (n, d) array of inputs to n outputs. Uses the Saltelli design:
+    model(A), model(B) and model(AB_i) (A with column i from B) are shared by
+    all indices, so each batch of n base samples costs n * (d + 2) model
+    evaluations. First order indices use the Saltelli (2010) estimator and total
+    indices the Jansen estimator. Batches are added until the largest
+    standard error is below tol or max_samples base samples are used.
+    design is 'lhs' (Latin hypercube) or 'qmc' (randomized Halton).
+    """
+    rng = np.random.default_rng(seed)
+    d = len(low)
+    # running sums of the per sample estimator terms and their squares
+    s1, s1_sq, st, st_sq = (np.zeros(d) for _ in range(4))
+    f_sum = f_sq = 0.
+    n = 0
+    converged = False
+    while n < max_samples:
+        m = min(batch_size, max_samples - n)
+        if design == 'lhs':
+            u = latin_hypercube(m, 2 * d, rng)
+        elif design == 'qmc':
+            u = halton(m, 2 * d, start=n, rng=seed)
+        else:
+            raise ValueError(f'Unknown design {design!r}')
+        a = scale_to_spread(u[:, :d], low, high, numeral)
+        b = scale_to_spread(u[:, d:], low, high, numeral)
+        # one big model call for A, B and all AB_i
+        ab = np.repeat(a[None], d, axis=0)
+        ab[np.arange(d), :, np.arange(d)] = b.T
+        y = np.asarray(model(np.concatenate([a, b, ab.reshape(d * m, d)])), dtype=float)
+        fa, fb, fab = y[:m], y[m:2 * m], y[2 * m:].reshape(d, m)
+
+        t1 = fb * (fab - fa)
+        t2 = 0.5 * (fa - fab)**2
+        s1 += t1.sum(1)
+        s1_sq += (t1**2).sum(1)
+        st += t2.sum(1)
+        st_sq += (t2**2).sum(1)
+        f_sum += fa.sum() + fb.sum()
+        f_sq += (fa**2).sum() + (fb**2).sum()
+        n += m
+
+        variance = f_sq / (2 * n) - (f_sum / (2 * n))**2
+        if variance <= 0:
+            raise ValueError('The model output does not vary over the spreads')
+        se1 = np.sqrt(np.maximum(s1_sq / n - (s1 / n)**2, 0) / n) / variance
+        se_t = np.sqrt(np.maximum(st_sq / n - (st / n)**2, 0) / n) / variance
+        if max(se1.max(), se_t.max()) < tol:
+            converged = True
+            break
+    return SobolResult(s1 / n / variance, st / n / variance, se1, se_t, n * (d + 2), converged)
+
+
+def propagate(model, low, high, numeral=None, n=100_000, design='lhs', seed=None):
+    """Model outputs for n samples of the input spreads, e.g. for percentiles of the result"""
+    u = latin_hypercube(n, len(low), seed) if design == 'lhs' else halton(n, len(low), rng=seed)
+    return np.asarray(model(scale_to_spread(u, low, high, numeral)))
+
+
+def point_risk_model(strike_probability, target_area=1.):
+    """
+    Individual risk at a point as a vectorized model of the uncertain inputs.
+
+    strike_probability is the probability per m2 for one fragment to land at
+    the point (from a probability map). The model takes columns: fragments
+    per year, probability of presence, lethality and risk reduction factor.
+    """
+    def model(x):
+        fragments, exposure, lethality, risk_reduction = x.T
+        return fragments * strike_probability * target_area * exposure * lethality / risk_reduction
+    return model
+
+
+
+def test_wind_samples_resampled_jointly():
+    # strong westerlies and calm easterlies, as many samples as fragments
+    speed, direction = np.repeat([20., 0.5], 1000), np.repeat([270., 90.], 1000)
+    s = simulate_landing(2000, Turbine(), speed, direction, chunk_size=1000, seed=1)
+    far = s.distance > 150
+    assert far.any() and (s.x[far] > 0).all()
+    assert not (s.x[:1000] > 0).all()  # resampled, not taken in order
+    biased = simulate_landing(2000, Turbine(), speed, direction, seed=1, wind_bias=6.)
+    assert biased.weight.std() > 0
+
+
+def test_per_fragment_wind_kept_in_order():
+    speed, direction = np.repeat([20., 0.5], 1000), np.repeat([270., 90.], 1000)
+    s = simulate_landing(2000, Turbine(), speed, direction, chunk_size=700, seed=1, per_fragment=True)
+    assert (s.x[:1000] > 0).all() and (s.distance[1000:] < s.distance[:1000].mean()).all()
+    for kwargs in (dict(n=1999), dict(n=2000, wind_bias=6.)):
+        try:
+            simulate_landing(turbine=Turbine(), wind_speed=speed, wind_direction=direction, per_fragment=True,
+                             **kwargs)
+        except ValueError:
+            continue
+        raise AssertionError(f'per fragment wind accepted with {kwargs}')
+
+
+def test_importance_weights_unbiased():
+    speeds = np.random.default_rng(0).weibull(2, 1000) * 8
+    plain = simulate_landing(50_000, Turbine(), speeds, np.zeros(1000), seed=1)
+    biased = simulate_landing(50_000, Turbine(), speeds, np.zeros(1000), seed=2,
+                              tip_bias=2., mass_bias=2., wind_bias=3.)
+    assert abs(biased.weight.mean() - 1) < 0.05
+    for distance in (150., 200., 250.):
+        a, b = exceedance_probability(plain, distance), exceedance_probability(biased, distance)
+        # the estimates agree within their confidence intervals
+        assert abs(a.value - b.value) < (a.high - a.low + b.high - b.low) / 2
+
+
+def test_tail_estimate_bounds():
+    weights = np.full(1000, 0.5)
+    none = weighted_estimate(np.zeros(1000), weights)
+    assert none.value == none.low == 0 and np.isclose(none.high, 3 * 0.5 / 1000, rtol=0.01)
+    one = weighted_estimate(np.arange(1000) == 0, weights)
+    assert one.low == 0 and one.high > one.value > 0
+
+
+def test_halton():
+    assert np.allclose(halton(3, 2), [[1 / 2, 1 / 3], [1 / 4, 2 / 3], [3 / 4, 1 / 9]])
+    assert np.array_equal(halton(2, 2, start=1), halton(3, 2)[1:])
+    shifted = halton(1000, 4, rng=1)
+    assert ((shifted >= 0) & (shifted < 1)).all() and not np.allclose(shifted, halton(1000, 4))
+
+
+def test_scale_to_spread():
+    u = latin_hypercube(100_000, 2, rng=1)
+    uniform = scale_to_spread(u, [0., 10.], [1., 20.])
+    assert uniform.min(0).tolist() >= [0., 10.] and uniform.max(0).tolist() <= [1., 20.]
+    # triangular: mean (low + numeral + high) / 3, mode at the numeral
+    triangular = scale_to_spread(u, [0., 10.], [1., 20.], numeral=[0.2, 19.])
+    assert np.allclose(triangular.mean(0), [1.2 / 3, 49 / 3], rtol=1e-3)
+    assert (triangular[:, 1] > 19.).mean() < (triangular[:, 1] < 19.).mean()
+
+
+def test_sobol_ishigami():
+    def ishigami(x, a=7., b=0.1):
+        return np.sin(x[:, 0]) + a * np.sin(x[:, 1])**2 + b * x[:, 2]**4 * np.sin(x[:, 0])
+
+    # analytical indices of the Ishigami function
+    first_order, total = [0.3139, 0.4424, 0.], [0.5576, 0.4424, 0.2437]
+    for design in ('lhs', 'qmc'):
+        result = sobol_indices(ishigami, [-np.pi] * 3, [np.pi] * 3, tol=0.005, design=design, seed=1)
+        assert result.converged
+        assert np.allclose(result.first_order, first_order, atol=0.01)
+        assert np.allclose(result.total, total, atol=0.01)
+
+
+if __name__ == '__main__':
+    s = simulate_landing(10**6, seed=0)
+    print(f'max throw distance {s.distance.max():.0f} m, '
+          f'99th percentile {np.percentile(s.distance, 99):.0f} m')
+    print(f'{throughput():.3g} fragments/s')
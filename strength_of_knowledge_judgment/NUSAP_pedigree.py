@@ -22,6 +22,8 @@ consensus regarding the use of the model and calculated data.
 """
 __author__  = 'Rolv.Bredesen'
 
+import numpy as np
+
 pedigree_matrix_research = { # Funtowicz and Ravetz, 1990
     'Score':[4,3,2,1,0],
     'Theoretical Structure': ['Established theroy', 'Theory-based model', 'Computational model', 'Statistical processing', 'Definitions'],
@@ -46,3 +48,158 @@ examples = dict(
     pedigree_assumptions_best_practice = [4,4,3,2,3,2,1],
     pedigree_assumptions_speculative = [2,0,2,1,1,1,1],
 )
+
+research_criteria = [k for k in pedigree_matrix_research if k != 'Score']
+assumption_criteria = [k for k in pedigree_assumptions if k != 'Score']
+# criteria marked as important above count double
+assumption_weights = [2 if k in ('Influence of situational limitations time, money etc',
+                                 'Sensitivity to views of analyst') else 1
+                      for k in assumption_criteria]
+MAX_SCORE = 4
+SOK_CLASSES = ['weak', 'moderate', 'strong']  # red, yellow, green
+
+
+class NUSAPStore:
+    """
+    Array backed store of NUSAP elements (Numeral, Unit, Spread, Assessment, Pedigree)
+
+    Elements for all inputs of all turbines in all projects are kept in a few
+    flat arrays, so strength of knowledge scoring and per project reporting are
+    single vectorized passes. Units, assessments and projects are stored as
+    codes into lookup lists.
+
+    >>> store = NUSAPStore(research_criteria)
+    >>> store.add('IceRisk 1.0', 'ice debris', 8800, 'kg/year', (7500, 10000), 'High > 90 %',
+    ...           examples['pedigree_research_icerisk1'])
+    0
+    >>> store.classify().tolist()
+    ['strong']
+    """
+
+    def __init__(self, criteria=research_criteria, weights=None, capacity=1024):
+        self.criteria = list(criteria)
+        self.weights = np.ones(len(self.criteria)) if weights is None else np.asarray(weights, float)
+        self.projects, self.units, self.assessments = [], [], []
+        # value -> code, one lookup per table
+        self._codes = {'projects': {}, 'units': {}, 'assessments': {}}
+        self.names = []
+        self.size = 0
+        self.numeral = np.empty(capacity)
+        self.spread = np.empty((capacity, 2))
+        self.pedigree = np.empty((capacity, len(self.criteria)), dtype=np.int8)
+        self.project = np.empty(capacity, dtype=np.int32)
+        self.unit = np.empty(capacity, dtype=np.int32)
+        self.assessment = np.empty(capacity, dtype=np.int32)
+
+    def __len__(self):
+        return self.size
+
+    def _encode(self, table, values):
+        """Codes of values in the lookup table (projects, units or assessments), unseen values are appended"""
+        uniques, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        lookup, names = self._codes[table], getattr(self, table)
+        codes = np.empty(len(uniques), dtype=np.int32)
+        for i, value in enumerate(uniques.tolist()):
+            if value not in lookup:
+                lookup[value] = len(names)
+                names.append(value)
+            codes[i] = lookup[value]
+        return codes[inverse.ravel()]
+
+    def _reserve(self, n):
+        capacity = len(self.numeral)
+        if self.size + n <= capacity:
+            return
+        capacity = max(2 * capacity, self.size + n)
+        for attr in ('numeral', 'spread', 'pedigree', 'project', 'unit', 'assessment'):
+            old = getattr(self, attr)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, attr, new)
+
+    def add(self, project, name, numeral, unit, spread, assessment, pedigree):
+        """Add one element, returns its index"""
+        return int(self.extend([project], [name], [numeral], [unit], [spread], [assessment], [pedigree])[0])
+
+    def extend(self, projects, names, numerals, units, spreads, assessments, pedigrees):
+        """Add many elements at once, one value per element in every column, returns their indices"""
+        pedigrees = np.asarray(pedigrees, dtype=np.int8)
+        n = len(pedigrees)
+        columns = dict(projects=projects, names=names, numerals=numerals, units=units, spreads=spreads,
+                       assessments=assessments)
+        uneven = [column for column, values in columns.items() if len(values) != n]
+        if uneven:
+            raise ValueError(f'Expected {n} values (one per pedigree) in {", ".join(uneven)}')
+        if n == 0:
+            return np.arange(self.size, self.size)
+        if pedigrees.ndim != 2 or pedigrees.shape[1] != len(self.criteria):
+            raise ValueError(f'Expected {len(self.criteria)} pedigree scores per element: {self.criteria}')
+        if pedigrees.min() < 0 or pedigrees.max() > MAX_SCORE:
+            raise ValueError(f'Pedigree scores must be between 0 and {MAX_SCORE}')
+        self._reserve(n)
+        s = slice(self.size, self.size + n)
+        self.numeral[s] = numerals
+        self.spread[s] = spreads
+        self.pedigree[s] = pedigrees
+        self.project[s] = self._encode('projects', projects)
+        self.unit[s] = self._encode('units', units)
+        self.assessment[s] = self._encode('assessments', assessments)
+        self.names.extend(names)
+        self.size += n
+        return np.arange(s.start, s.stop)
+
+    def strength(self):
+        """Weighted pedigree score normalized to 0 (no knowledge) .. 1 (strong)"""
+        return self.pedigree[:self.size] @ self.weights / (MAX_SCORE * self.weights.sum())
+
+    def relative_spread(self):
+        """Width of the spread relative to the numeral"""
+        spread = self.spread[:self.size]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (spread[:, 1] - spread[:, 0]) / np.abs(self.numeral[:self.size])
+
+    def classify(self, thresholds=(1 / 3, 2 / 3), weak_score=0, strong_score=2, codes=False):
+        """
+        Strength of knowledge class per element (see strength_of_knowledge_index.md)
+
+        Weak if the normalized strength is below thresholds[0] or any criterion
+        scores weak_score or lower (one weak condition is enough). Strong if the
+        strength reaches thresholds[1] and all criteria score at least
+        strong_score. Moderate otherwise. Returns labels, or 0/1/2 with codes=True.
+        """
+        strength = self.strength()
+        pedigree = self.pedigree[:self.size]
+        weak = (strength < thresholds[0]) | (pedigree <= weak_score).any(axis=1)
+        strong = (strength >= thresholds[1]) & (pedigree >= strong_score).all(axis=1) & ~weak
+        classes = np.where(weak, 0, np.where(strong, 2, 1))
+        return classes if codes else np.array(SOK_CLASSES)[classes]
+
+    def by_project(self, **classify_kwargs):
+        """Per project count, mean and minimum strength and share of each class"""
+        project = self.project[:self.size]
+        n_projects = len(self.projects)
+        count = np.bincount(project, minlength=n_projects)
+        strength = self.strength()
+        lowest = np.full(n_projects, np.inf)
+        np.minimum.at(lowest, project, strength)
+        classes = self.classify(codes=True, **classify_kwargs)
+        shares = np.bincount(project * 3 + classes, minlength=3 * n_projects).reshape(n_projects, 3)
+        report = dict(project=list(self.projects), elements=count,
+                      mean_strength=np.bincount(project, strength, n_projects) / np.maximum(count, 1),
+                      min_strength=lowest)
+        for i, label in enumerate(SOK_CLASSES):
+            report[f'share_{label}'] = shares[:, i] / np.maximum(count, 1)
+        return report
+
+
+def test_extend_checks_columns():
+    store = NUSAPStore(research_criteria)
+    pedigrees = [examples['pedigree_research_icerisk1']] * 2
+    try:
+        store.extend(['p', 'p'], ['a'], [1., 2.], ['kg'] * 2, [(0., 2.)] * 2, ['High'] * 2, pedigrees)
+    except ValueError as e:
+        assert 'names' in str(e)
+    else:
+        raise AssertionError('uneven columns accepted')
+    assert len(store) == 0 and store.names == []
+    assert len(store.extend([], [], [], [], [], [], [])) == 0 and len(store) == 0